@@ -0,0 +1,337 @@
+import argparse
+import asyncio
+import importlib
+import itertools
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+from collections import Counter
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+FIXTURES = Path(__file__).resolve().parent / "fixtures"
+sys.path.insert(0, str(ROOT))
+
+TOKEN = "123456:bench"
+AUDIO_DURATION = 180
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def track_id(query: str) -> int:
+    return 20000 + zlib.crc32(query.encode()) % 1000000
+
+
+def make_audio(path: Path, size: int):
+    frame = b"\xff\xfb\x90\x64" + bytes(413)
+    with open(path, "wb") as f:
+        f.write(frame * (size // len(frame) + 1))
+
+
+def serve(port: int, audio: str, latency: float):
+    """Fake Bot API and Zaycev.net on one port; runs in a child process so its CPU is not measured."""
+    from aiohttp import web
+
+    search = (FIXTURES / "zaycev_search.html").read_text(encoding="utf-8")
+    track = (FIXTURES / "zaycev_track.html").read_text(encoding="utf-8")
+    base = f"http://127.0.0.1:{port}"
+    body = Path(audio).read_bytes()
+    counter = itertools.count(1)
+
+    async def delay():
+        if latency:
+            await asyncio.sleep(latency)
+
+    async def zaycev_search(request):
+        await delay()
+        tid = track_id(request.query.get("query_search", ""))
+        return web.Response(text=search.replace("/music/10000/", f"/music/{tid}/", 1), content_type="text/html")
+
+    async def zaycev_track(request):
+        await delay()
+        tid = request.match_info["id"]
+        page = track.replace("https://cdn.zaycev.net", base).replace("/download/10042/", f"/download/{tid}/")
+        return web.Response(text=page, content_type="text/html")
+
+    async def download(request):
+        await delay()
+        return web.Response(body=body, content_type="audio/mpeg")
+
+    def message(chat_id, **extra):
+        return dict(message_id=next(counter), date=int(time.time()),
+                    chat={"id": int(chat_id or 0), "type": "private"}, **extra)
+
+    async def bot_api(request):
+        await delay()
+        method = request.match_info["method"]
+        form = await request.post()
+        if method == "deleteMessage":
+            result = True
+        elif method == "sendAudio":
+            n = next(counter)
+            result = message(form.get("chat_id"), audio={"file_id": f"bench-{n}", "file_unique_id": str(n),
+                                                         "duration": AUDIO_DURATION})
+        elif method in ("sendMessage", "editMessageText"):
+            result = message(form.get("chat_id"), text=form.get("text", ""))
+        elif method == "getMe":
+            result = {"id": 123456, "is_bot": True, "first_name": "bench"}
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    app = web.Application(client_max_size=1 << 30)
+    app.router.add_get("/search.html", zaycev_search)
+    app.router.add_get("/music/{id}/{name}", zaycev_track)
+    app.router.add_get("/download/{id}/{name}", download)
+    app.router.add_post("/bot{token}/{method}", bot_api)
+    web.run_app(app, host="127.0.0.1", port=port, print=None, access_log=None)
+
+
+class FakeYoutubeDL:
+    """Stands in for yt_dlp.YoutubeDL: search returns one mp3 entry, download copies the local file."""
+
+    audio = None
+    latency = 0.0
+
+    def __init__(self, opts=None):
+        self.opts = opts or {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def entry(self, video_id: str, title: str) -> dict:
+        return {
+            "id": video_id,
+            "title": title,
+            "duration": AUDIO_DURATION,
+            "ext": "mp3",
+            "acodec": "mp3",
+            "filesize": os.path.getsize(self.audio),
+            "url": f"file://{self.audio}",
+            "extractor_key": "Youtube",
+        }
+
+    def extract_info(self, search, download=False):
+        time.sleep(self.latency)
+        if "watch?v=" in search:
+            video_id = search.rsplit("=", 1)[-1]
+            return self.entry(video_id, video_id)
+        prefix, _, query = search.partition(":")
+        count = int(prefix[len("ytsearch"):] or 1)
+        return {"entries": [self.entry(f"bench{track_id(query)}-{i}", f"{query} #{i}") for i in range(count)]}
+
+    def sanitize_info(self, info):
+        return info
+
+    def process_ie_result(self, info, download=True):
+        time.sleep(self.latency)
+        path = self.opts["outtmpl"].replace("%(ext)s", "mp3")
+        shutil.copyfile(self.audio, path)
+        return {"requested_downloads": [{"filepath": path, "acodec": "mp3"}]}
+
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(q * len(ordered))) - 1))]
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+async def run(mb, args) -> dict:
+    from aiogram import types
+
+    queries = [f"bench track {i % (args.distinct or args.requests)}" for i in range(args.requests)]
+    users = args.users or args.concurrency
+    ids = itertools.count(1)
+
+    async def via_handler(i, query):
+        user = 1000 + i % users
+        update = types.Update.model_validate({
+            "update_id": next(ids),
+            "message": {"message_id": next(ids), "date": int(time.time()), "text": query,
+                        "chat": {"id": user, "type": "private"},
+                        "from": {"id": user, "is_bot": False, "first_name": "bench"}},
+        }, context={"bot": mb.bot})
+        await mb.dp.feed_update(mb.bot, update)
+
+    async def via_downloader(i, query):
+        async with mb.workspace.job() as workdir:
+            res, _ = await mb.downloader.download_track(query, None, mb.Job(query, workdir))
+        if not res:
+            raise RuntimeError("not found")
+
+    call = via_handler if args.mode == "handler" else via_downloader
+    pending = list(enumerate(queries))
+    latencies, errors = [], Counter()
+
+    async def worker():
+        while pending:
+            i, query = pending.pop(0)
+            started = time.perf_counter()
+            try:
+                await call(i, query)
+            except Exception as e:
+                errors[type(e).__name__] += 1
+            latencies.append(time.perf_counter() - started)
+
+    def outcomes() -> Counter:
+        counts = Counter()
+        for (name, labels), value in mb.metrics.values.items():
+            if name == "requests_total":
+                counts[dict(labels)["outcome"]] += int(value)
+        return counts
+
+    for i in range(args.warmup):
+        await call(i, f"bench warmup {i}")
+    before = outcomes()
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    wall = time.perf_counter() - started
+    after = resource.getrusage(resource.RUSAGE_SELF)
+    cpu = (after.ru_utime - usage.ru_utime) + (after.ru_stime - usage.ru_stime)
+
+    return {
+        "requests": args.requests,
+        "wall_s": round(wall, 3),
+        "rps": round(args.requests / wall, 2),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 1),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 1),
+        "max_ms": round(max(latencies) * 1000, 1),
+        "cpu_s": round(cpu, 3),
+        "cpu_per_request_ms": round(cpu / args.requests * 1000, 2),
+        "peak_rss_mb": round(after.ru_maxrss / 1024, 1),
+        "errors": dict(errors),
+        "outcomes": dict(outcomes() - before),
+        "flights": mb.flights.stats(),
+        "file_cache": mb.file_cache.stats(),
+    }
+
+
+def compare(old: dict, new: dict):
+    print(f"\n{'metric':<20}{'before':>12}{'after':>12}{'change':>10}")
+    for key in ("rps", "p50_ms", "p95_ms", "p99_ms", "cpu_per_request_ms", "peak_rss_mb"):
+        a, b = old["results"].get(key), new["results"].get(key)
+        if a is None or b is None:
+            continue
+        change = f"{(b - a) / a:+.0%}" if a else "n/a"
+        print(f"{key:<20}{a:>12}{b:>12}{change:>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline load test for the download pipeline")
+    parser.add_argument("--mode", choices=("handler", "downloader"), default="handler",
+                        help="feed Telegram updates through the dispatcher, or call download_track directly")
+    parser.add_argument("--source", choices=("zaycev", "youtube", "all"), default="zaycev")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--users", type=int, default=0, help="distinct users (default: one per concurrent request)")
+    parser.add_argument("--distinct", type=int, default=0,
+                        help="distinct queries; fewer than --requests exercises coalescing and caches")
+    parser.add_argument("--warmup", type=int, default=5)
+    parser.add_argument("--audio-kb", type=int, default=512)
+    parser.add_argument("--latency-ms", type=float, default=20, help="added delay per fake HTTP/yt-dlp call")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                        help="bot setting to override, e.g. --env MAX_ACTIVE_JOBS=16")
+    parser.add_argument("--json", help="write results to this file")
+    parser.add_argument("--compare", help="earlier --json result to compare against")
+    args = parser.parse_args()
+
+    tmp = Path(tempfile.mkdtemp(prefix="music_bench_"))
+    audio = tmp / "fixture.mp3"
+    make_audio(audio, args.audio_kb * 1024)
+    port = free_port()
+    users = args.users or args.concurrency
+    os.environ.update({
+        "BOT_TOKEN": TOKEN,
+        "BOT_API_URL": f"http://127.0.0.1:{port}",
+        "ZAYCEV_URL": f"http://127.0.0.1:{port}",
+        "FILE_CACHE_PATH": ":memory:",
+        "WORKSPACE_DIR": str(tmp / "work"),
+        "PORT": "0",
+        "REDIS_URL": "",
+        "MAX_ACTIVE_JOBS": str(args.concurrency),
+        "MAX_QUEUED_JOBS": str(args.requests),
+        "PER_USER_JOBS": str(max(1, -(-args.concurrency // users))),
+    })
+    for item in args.env:
+        key, _, value = item.partition("=")
+        os.environ[key] = value
+
+    server = multiprocessing.Process(target=serve, args=(port, str(audio), args.latency_ms / 1000), daemon=True)
+    server.start()
+    try:
+        for _ in range(100):
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=0.1).close()
+                break
+            except OSError:
+                time.sleep(0.05)
+
+        import yt_dlp
+        FakeYoutubeDL.audio = str(audio)
+        FakeYoutubeDL.latency = args.latency_ms / 1000
+        yt_dlp.YoutubeDL = FakeYoutubeDL
+        import logging
+        logging.disable(logging.WARNING)
+        mb = importlib.import_module("music_bot")
+        names = {"zaycev": ("Zaycev.net",), "youtube": ("YouTube",), "all": ("YouTube", "Zaycev.net")}[args.source]
+        mb.downloader.sources = tuple(s for s in mb.downloader.sources if s[0] in names)
+
+        async def session():
+            mb.workspace.start(mb.WORKSPACE_ORPHAN_AGE)
+            try:
+                return await run(mb, args)
+            finally:
+                await mb.http.close()
+                await mb.bot.session.close()
+                mb.engine.shutdown()
+
+        results = asyncio.run(session())
+    finally:
+        server.terminate()
+        server.join()
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    config = {k: v for k, v in vars(args).items() if k not in ("json", "compare")}
+    report = {"commit": git_commit(), "python": sys.version.split()[0], "cpus": os.cpu_count(),
+              "config": config, "results": results}
+    r = results
+    print(f"{args.mode}/{args.source}: {r['requests']} requests, concurrency {args.concurrency}")
+    print(f"throughput  {r['rps']} req/s in {r['wall_s']} s")
+    print(f"latency     p50 {r['p50_ms']} ms, p95 {r['p95_ms']} ms, p99 {r['p99_ms']} ms, max {r['max_ms']} ms")
+    print(f"cpu         {r['cpu_s']} s total, {r['cpu_per_request_ms']} ms per request")
+    print(f"memory      peak RSS {r['peak_rss_mb']} MB")
+    print(f"outcomes    {r['outcomes']}  errors {r['errors']}")
+    if args.compare:
+        compare(json.loads(Path(args.compare).read_text(encoding="utf-8")), report)
+    if args.json:
+        Path(args.json).write_text(json.dumps(report, indent=2), encoding="utf-8")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+import argparse
+import json
+import os
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+FIXTURES = Path(__file__).resolve().parent / "fixtures"
+sys.path.insert(0, str(ROOT))
+os.environ.setdefault("BOT_TOKEN", "123456:bench")
+os.environ.setdefault("FILE_CACHE_PATH", ":memory:")
+
+import music_bot as mb
+
+
+def timed(func, arg, rounds: int) -> float:
+    func(arg)
+    started = time.perf_counter()
+    for _ in range(rounds):
+        func(arg)
+    return (time.perf_counter() - started) / rounds * 1e6
+
+
+def scan(scanner_factory, text: str, chunk: int) -> tuple:
+    scanner = scanner_factory()
+    for pos in range(0, len(text), chunk):
+        found = scanner.feed(text[pos:pos + chunk])
+        if found:
+            return found, min(pos + chunk, len(text))
+    return scanner.result, len(text)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Zaycev HTML extractor micro-benchmark")
+    parser.add_argument("--rounds", type=int, default=200)
+    parser.add_argument("--chunk", type=int, default=16384, help="chunk size for the streaming scanner")
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+
+    search = (FIXTURES / "zaycev_search.html").read_text(encoding="utf-8")
+    track = (FIXTURES / "zaycev_track.html").read_text(encoding="utf-8")
+
+    backends = [mb.Bs4Extractor(), mb.StreamExtractor()]
+    if mb.lxml_html is not None:
+        backends.append(mb.LxmlExtractor())
+    if mb.HTMLParser is not None:
+        backends.append(mb.SelectolaxExtractor())
+
+    expected = (mb.Bs4Extractor().search_link(search), mb.Bs4Extractor().track_mp3(track))
+    results = {}
+    for ex in backends:
+        got = (ex.search_link(search), ex.track_mp3(track))
+        results[ex.name] = {
+            "search_us": round(timed(ex.search_link, search, args.rounds), 1),
+            "track_us": round(timed(ex.track_mp3, track, args.rounds), 1),
+            "matches_bs4": got == expected,
+        }
+
+    stream = mb.StreamExtractor()
+    for kind, text, factory in (("search", search, stream.search_scanner),
+                                ("track", track, stream.track_scanner)):
+        _, consumed = scan(factory, text, args.chunk)
+        results["stream"][f"{kind}_bytes_read"] = consumed
+        results["stream"][f"{kind}_scan_us"] = round(
+            timed(lambda t: scan(factory, t, args.chunk), text, args.rounds), 1)
+
+    print(f"{'backend':<12}{'search µs':>12}{'track µs':>12}  same as bs4")
+    for name, r in results.items():
+        print(f"{name:<12}{r['search_us']:>12}{r['track_us']:>12}  {r['matches_bs4']}")
+    print(f"stream scanner stops after {results['stream']['search_bytes_read']}/{len(search)} "
+          f"and {results['stream']['track_bytes_read']}/{len(track)} characters")
+
+    if args.json:
+        Path(args.json).write_text(json.dumps(results, indent=2), encoding="utf-8")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,40 +1,185 @@
 import os
+import sys
+import json
+import random
+import socket
 import tempfile
 import asyncio
 import logging
 from pathlib import Path
-from typing import Optional
+from typing import Optional, AsyncGenerator
 import time
 import urllib.parse
 import re
+import threading
+import contextvars
+import sqlite3
+import shutil
+import contextlib
+import codecs
+import html as htmlmod
+import subprocess
+import hmac
+import signal
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.filters import Command
-from aiogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer, PRODUCTION
+from aiogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, FSInputFile, InputFile
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.storage.memory import MemoryStorage
 
 import yt_dlp
-import requests
+import aiohttp
+from aiohttp import web
 from bs4 import BeautifulSoup
 from dotenv import load_dotenv
 
+try:
+    from lxml import etree, html as lxml_html
+except ImportError:
+    lxml_html = None
+
+try:
+    from selectolax.lexbor import LexborHTMLParser as HTMLParser
+except ImportError:
+    try:
+        from selectolax.parser import HTMLParser
+    except ImportError:
+        HTMLParser = None
+
+try:
+    from redis import asyncio as aioredis
+except ImportError:
+    aioredis = None
+
 load_dotenv()
 
+current_request = contextvars.ContextVar("current_request", default="-")
+_record_factory = logging.getLogRecordFactory()
+
+def _log_record(*args, **kwargs):
+    record = _record_factory(*args, **kwargs)
+    record.request_id = current_request.get()[:16]
+    return record
+
+logging.setLogRecordFactory(_log_record)
 logging.basicConfig(
     level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s'
+    format='%(asctime)s - %(levelname)s - [%(request_id)s] %(message)s'
 )
 logger = logging.getLogger(__name__)
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
-MAX_FILE_SIZE = 50 * 1024 * 1024
+BOT_API_URL = os.getenv("BOT_API_URL", "").rstrip("/")
+BOT_API_LOCAL = os.getenv("BOT_API_LOCAL", "0") == "1"
+BOT_API_POOL_LIMIT = int(os.getenv("BOT_API_POOL_LIMIT", "100"))
+BOT_API_TIMEOUT = float(os.getenv("BOT_API_TIMEOUT", "300"))
+MAX_FILE_SIZE = int(os.getenv("MAX_FILE_SIZE_MB") or ("2000" if BOT_API_URL and BOT_API_LOCAL else "50")) * 1024 * 1024
 MAX_DURATION = 600
 TEMP_DIR = tempfile.gettempdir()
+WORKSPACE_DIR = os.getenv("WORKSPACE_DIR", os.path.join(TEMP_DIR, "music_bot"))
+WORKSPACE_QUOTA = int(os.getenv("WORKSPACE_QUOTA_MB", "1024")) * 1024 * 1024
+WORKSPACE_RESERVE = int(os.getenv("WORKSPACE_RESERVE_MB", "100")) * 1024 * 1024
+WORKSPACE_SWEEP_INTERVAL = int(os.getenv("WORKSPACE_SWEEP_INTERVAL", "600"))
+WORKSPACE_ORPHAN_AGE = int(os.getenv("WORKSPACE_ORPHAN_AGE", "3600"))
+EXTRACT_WORKERS = int(os.getenv("EXTRACT_WORKERS", "4"))
+DOWNLOAD_WORKERS = int(os.getenv("DOWNLOAD_WORKERS", "8"))
+PARSE_WORKERS = int(os.getenv("PARSE_WORKERS", "4"))
+TRANSCODE_WORKERS = int(os.getenv("TRANSCODE_WORKERS", str(os.cpu_count() or 2)))
+FILE_CACHE_PATH = os.getenv("FILE_CACHE_PATH", "file_ids.sqlite3")
+FILE_CACHE_TTL = int(os.getenv("FILE_CACHE_TTL", str(30 * 24 * 3600)))
+FILE_CACHE_SIZE = int(os.getenv("FILE_CACHE_SIZE", "20000"))
+ZAYCEV_URL = os.getenv("ZAYCEV_URL", "https://zaycev.net").rstrip("/")
+HTTP_LIMIT = int(os.getenv("HTTP_LIMIT", "100"))
+HTTP_LIMIT_PER_HOST = int(os.getenv("HTTP_LIMIT_PER_HOST", "16"))
+HTTP_DNS_TTL = int(os.getenv("HTTP_DNS_TTL", "300"))
+HTTP_KEEPALIVE = float(os.getenv("HTTP_KEEPALIVE", "30"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "10"))
+HTTP_FIRST_BYTE_TIMEOUT = float(os.getenv("HTTP_FIRST_BYTE_TIMEOUT", "20"))
+HTTP_TOTAL_TIMEOUT = float(os.getenv("HTTP_TOTAL_TIMEOUT", "120"))
+ZAYCEV_SEARCH_TTL = int(os.getenv("ZAYCEV_SEARCH_TTL", "3600"))
+ZAYCEV_TRACK_TTL = int(os.getenv("ZAYCEV_TRACK_TTL", "3600"))
+ZAYCEV_NEGATIVE_TTL = int(os.getenv("ZAYCEV_NEGATIVE_TTL", "300"))
+ZAYCEV_CACHE_SIZE = int(os.getenv("ZAYCEV_CACHE_SIZE", "5000"))
+ZAYCEV_PARSER = os.getenv("ZAYCEV_PARSER", "auto")
+STREAM_CHUNK_SIZE = int(os.getenv("STREAM_CHUNK_KB", "256")) * 1024
+TRANSCODE_POLICY = os.getenv("TRANSCODE_POLICY", "auto")
+TRANSCODE_BITRATE = int(os.getenv("TRANSCODE_BITRATE", "192"))
+TRANSCODE_THREADS = int(os.getenv("TRANSCODE_THREADS", "1"))
+STREAM_UPLOAD = os.getenv("STREAM_UPLOAD", "0") == "1"
+RESOLVE_CACHE_TTL = int(os.getenv("RESOLVE_CACHE_TTL", "1800"))
+RESOLVE_CACHE_SIZE = int(os.getenv("RESOLVE_CACHE_SIZE", "2000"))
+MAX_ACTIVE_JOBS = int(os.getenv("MAX_ACTIVE_JOBS", "4"))
+PER_USER_JOBS = int(os.getenv("PER_USER_JOBS", "2"))
+MAX_QUEUED_JOBS = int(os.getenv("MAX_QUEUED_JOBS", "50"))
+QUEUE_NOTIFY_INTERVAL = float(os.getenv("QUEUE_NOTIFY_INTERVAL", "5"))
+RACE_MODE = os.getenv("RACE_MODE", "0") == "1"
+PICKER_RESULTS = int(os.getenv("PICKER_RESULTS", "5"))
+PICKER_DEFAULT = os.getenv("PICKER_DEFAULT", "0") == "1"
+PICKER_TTL = int(os.getenv("PICKER_TTL", "900"))
+PICKER_CHATS = int(os.getenv("PICKER_CHATS", "10000"))
+PICKER_NEGATIVE_TTL = int(os.getenv("PICKER_NEGATIVE_TTL", "300"))
+HEDGE_DELAY = float(os.getenv("HEDGE_DELAY", "2"))
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "64"))
+WEBHOOK_QUEUE = int(os.getenv("WEBHOOK_QUEUE", "1000"))
+SERVER_HOST = os.getenv("SERVER_HOST", "0.0.0.0")
+SERVER_PORT = int(os.getenv("PORT", "8080"))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9090"))
+REDIS_URL = os.getenv("REDIS_URL", "")
+REDIS_PREFIX = os.getenv("REDIS_PREFIX", "music")
+FSM_STORAGE = os.getenv("FSM_STORAGE", "redis" if REDIS_URL else "memory")
+FSM_TTL = int(os.getenv("FSM_TTL", "86400"))
+JOB_QUEUE = os.getenv("JOB_QUEUE", "redis" if REDIS_URL else "local")
+RUN_MODE = os.getenv("RUN_MODE", "all")
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", str(MAX_ACTIVE_JOBS)))
+WORKER_HEARTBEAT = int(os.getenv("WORKER_HEARTBEAT", "15"))
+JOB_INFLIGHT_TTL = int(os.getenv("JOB_INFLIGHT_TTL", "3600"))
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0"))
+TRACE_SLOW_SECONDS = float(os.getenv("TRACE_SLOW_SECONDS", "0"))
+TRACE_FILE = os.getenv("TRACE_FILE", "")
+TRACE_ENDPOINT = os.getenv("TRACE_ENDPOINT", "")
+TRACE_SERVICE = os.getenv("TRACE_SERVICE", "music-bot")
+TRACE_FLUSH_INTERVAL = float(os.getenv("TRACE_FLUSH_INTERVAL", "5"))
+TRACE_BUFFER = int(os.getenv("TRACE_BUFFER", "1000"))
+ADMIN_IDS = {int(x) for x in os.getenv("ADMIN_IDS", "").replace(" ", "").split(",") if x}
+
+def make_bot() -> Bot:
+    api = TelegramAPIServer.from_base(BOT_API_URL, is_local=BOT_API_LOCAL) if BOT_API_URL else PRODUCTION
+    session = AiohttpSession(api=api, limit=BOT_API_POOL_LIMIT, timeout=BOT_API_TIMEOUT)
+    return Bot(token=BOT_TOKEN, session=session)
 
-bot = Bot(token=BOT_TOKEN)
-storage = MemoryStorage()
+def make_redis():
+    if not REDIS_URL:
+        return None
+    if REDIS_URL.startswith("fakeredis://"):
+        from fakeredis import FakeAsyncRedis
+        return FakeAsyncRedis()
+    if aioredis is None:
+        raise RuntimeError("REDIS_URL is set but the redis package is not installed")
+    return aioredis.Redis.from_url(REDIS_URL)
+
+def make_storage():
+    if FSM_STORAGE != "redis":
+        return MemoryStorage()
+    if redis_client is None:
+        raise RuntimeError("FSM_STORAGE=redis needs REDIS_URL")
+    from aiogram.fsm.storage.redis import RedisStorage, DefaultKeyBuilder
+    return RedisStorage(redis_client, key_builder=DefaultKeyBuilder(prefix=f"{REDIS_PREFIX}:fsm"),
+                        state_ttl=FSM_TTL, data_ttl=FSM_TTL)
+
+bot = make_bot()
+redis_client = make_redis()
+storage = make_storage()
 dp = Dispatcher(storage=storage)
 
 TEXTS = {
@@ -42,166 +187,1751 @@ TEXTS = {
 
 Что я умею:
 • Ищу музыку в YouTube, Zaycev.net, альтернативных источниках
-• Отправляю MP3 (до 50MB, до 10 минут)
+• Отправляю MP3 (до {}MB, до 10 минут)
 
-Просто напишите название трека.""",
+Просто напишите название трека.""".format(MAX_FILE_SIZE // 1048576),
     "help": """Справка
 
 Команды:
 /start — меню
+/find <название> — показать несколько вариантов и выбрать нужный
 /help — справка""",
     "search_prompt": "Введите название трека:",
+    "pick_search": "🔍 Ищу варианты: {}",
+    "pick_prompt": "Выберите трек для «{}»:",
+    "pick_expired": "Результаты поиска устарели, повторите запрос.",
+    "pick_cancelled": "Выбор отменён.",
+    "downloading": "⬇️ Загружаю: {}",
     "searching_youtube": "Ищу на YouTube: {}",
     "searching_zaycev": "Ищу на Zaycev.net: {}",
     "searching_alternative": "Ищу в альтернативных: {}",
+    "searching_race": "Ищу во всех источниках: {}",
     "sending": "Отправляю: {}",
     "not_found_anywhere": "Не найдено нигде: {}",
     "too_short": "Слишком короткий запрос.",
     "too_long": "Слишком длинный запрос.",
     "too_long_track": "Трек длиннее 10 минут.",
-    "too_big_file": "Файл больше 50MB.",
-    "error": "Ошибка при поиске."
+    "too_big_file": f"Файл больше {MAX_FILE_SIZE // 1048576}MB.",
+    "error": "Ошибка при поиске.",
+    "queued": "⏳ В очереди на загрузку, позиция: {}",
+    "queue_full": "Сейчас слишком много запросов, попробуйте через минуту.",
+    "user_busy": "У вас уже есть загрузки в работе, дождитесь их завершения."
 }
 
 class MusicStates(StatesGroup):
     waiting_search = State()
+    waiting_pick = State()
 
-class MultiSourceDownloader:
-    def __init__(self):
-        self.session = requests.Session()
-        self.session.headers.update({'User-Agent': 'Mozilla/5.0'})
-
-    async def search_youtube(self, query: str) -> Optional[str]:
-        output = os.path.join(TEMP_DIR, f"yt_{int(time.time())}")
-        opts = {
-            'format': 'bestaudio[ext=m4a]/bestaudio/best',
-            'outtmpl': f'{output}.%(ext)s',
-            'quiet': True,
-            'socket_timeout': 30,
-            'postprocessors': [{'key': 'FFmpegExtractAudio'}],
-            'cookiefile': 'youtube_cookies.txt'
+def normalize_query(query: str) -> str:
+    return " ".join(re.sub(r"[^\w\s]", " ", query.casefold()).split())
+
+class Job:
+    def __init__(self, query: str, workdir: str):
+        self.query = query
+        self.workdir = workdir
+        self.track_id = None
+        self.file_id = None
+        self.cancelled = threading.Event()
+        self.flight = None
+        self.owner = None
+
+    def adopt(self, other: "Job"):
+        self.track_id = other.track_id
+        self.file_id = other.file_id
+        self.owner = other.owner
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.workdir, name)
+
+def disk_usage(path: str) -> int:
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    total = 0
+    for root, _, files in os.walk(path):
+        for f in files:
+            try:
+                total += os.path.getsize(os.path.join(root, f))
+            except OSError:
+                pass
+    return total
+
+class Workspace:
+    # Only entries with these prefixes are ever swept from root, so pointing WORKSPACE_DIR
+    # at a shared directory such as /tmp leaves everything else in it alone
+    OWNED = ("musicbot-", "job_")
+
+    def __init__(self, root: str, quota: int, reserve: int):
+        # Several processes may share root (bot and workers on one volume): each one owns
+        # a subdirectory and only touches the others' once they have gone stale
+        self.root = root
+        self.path = os.path.join(root, f"musicbot-{socket.gethostname()}-{os.getpid()}")
+        self.quota = quota
+        self.reserve = reserve
+        self.live = set()
+        self.waiting = 0
+        self.reclaimed = 0
+        self.cond = None
+
+    def _remove(self, path: str) -> int:
+        size = disk_usage(path)
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            with contextlib.suppress(OSError):
+                os.remove(path)
+        self.reclaimed += size
+        return size
+
+    def _sweep_dir(self, path: str, max_age: float, skip, prefixes=("",)) -> int:
+        freed = 0
+        now = time.time()
+        with os.scandir(path) as it:
+            for entry in it:
+                if entry.path in skip or not entry.name.startswith(prefixes):
+                    continue
+                try:
+                    age = now - entry.stat(follow_symlinks=False).st_mtime
+                except OSError:
+                    continue
+                if age >= max_age:
+                    freed += self._remove(entry.path)
+        return freed
+
+    def sweep(self, max_age: float = 0, orphan_age: float = None) -> int:
+        # Our own directory doubles as a liveness mark for the other processes
+        Path(self.path).mkdir(parents=True, exist_ok=True)
+        os.utime(self.path)
+        freed = self._sweep_dir(self.path, max_age, self.live)
+        freed += self._sweep_dir(self.root, max_age if orphan_age is None else orphan_age, {self.path}, self.OWNED)
+        if freed:
+            logger.info(f"Workspace sweep reclaimed {freed} bytes")
+        return freed
+
+    async def sweeper(self, interval: int, max_age: int):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                self.sweep(max_age)
+            except Exception as e:
+                logger.error(f"Workspace sweep error: {e}")
+
+    def start(self, orphan_age: float):
+        self.cond = asyncio.Condition()
+        self.sweep(0, orphan_age)
+
+    def committed(self) -> int:
+        # The reservation is a floor: a job that already wrote more counts its real size
+        return sum(max(self.reserve, disk_usage(path)) for path in self.live)
+
+    @contextlib.asynccontextmanager
+    async def job(self):
+        async with self.cond:
+            self.waiting += 1
+            try:
+                await self.cond.wait_for(lambda: not self.live or self.committed() + self.reserve <= self.quota)
+            finally:
+                self.waiting -= 1
+            Path(self.path).mkdir(parents=True, exist_ok=True)
+            path = tempfile.mkdtemp(prefix="job_", dir=self.path)
+            self.live.add(path)
+        try:
+            yield path
+        finally:
+            self._remove(path)
+            async with self.cond:
+                self.live.discard(path)
+                self.cond.notify_all()
+
+    def stats(self) -> dict:
+        return {
+            "jobs": len(self.live),
+            "waiting": self.waiting,
+            "usage": disk_usage(self.path),
+            "committed": self.committed(),
+            "quota": self.quota,
+            "reclaimed": self.reclaimed,
         }
+
+workspace = Workspace(WORKSPACE_DIR, WORKSPACE_QUOTA, WORKSPACE_RESERVE)
+
+class Candidate:
+    __slots__ = ("source", "id", "title", "duration", "filesize", "url", "expires", "info")
+
+    def __init__(self, source: str, id: str, title: str = "", duration: int = 0,
+                 filesize: Optional[int] = None, url: Optional[str] = None,
+                 expires: Optional[float] = None, info: Optional[dict] = None):
+        self.source = source
+        self.id = id
+        self.title = title
+        self.duration = duration or 0
+        self.filesize = filesize
+        self.url = url
+        self.expires = expires
+        self.info = info
+
+    @property
+    def key(self) -> str:
+        return f"{self.source}:{self.id}"
+
+# Only these fields of a resolved yt-dlp info dict are kept on a Candidate: the
+# full dict carries every format with its URL and headers (~100 KB per video)
+YDL_INFO_KEYS = ("id", "title", "duration", "extractor", "extractor_key", "webpage_url",
+                 "original_url", "webpage_url_basename", "webpage_url_domain", "display_id",
+                 "format_id", "url", "ext", "acodec", "http_headers", "protocol")
+YDL_FORMAT_KEYS = ("format_id", "url", "ext", "acodec", "vcodec", "abr", "tbr", "asr",
+                   "filesize", "filesize_approx", "protocol", "http_headers", "container",
+                   "manifest_url", "fragment_base_url", "fragments", "downloader_options")
+
+def compact_info(info: dict) -> dict:
+    """Trim a resolved info dict to the chosen format(s), enough for process_ie_result."""
+    small = {k: info[k] for k in YDL_INFO_KEYS if info.get(k) is not None}
+    chosen = info.get('requested_formats') or [info]
+    small['formats'] = [{k: f[k] for k in YDL_FORMAT_KEYS if f.get(k) is not None} for f in chosen]
+    return small
+
+def url_expiry(url: Optional[str]) -> Optional[float]:
+    if not url:
+        return None
+    expire = urllib.parse.parse_qs(urllib.parse.urlparse(url).query).get("expire")
+    if expire and expire[0].isdigit():
+        return float(expire[0])
+    m = re.search(r"/expire/(\d+)", url)
+    return float(m.group(1)) if m else None
+
+class TTLCache:
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.data = OrderedDict()
+        self.hits = self.misses = 0
+
+    def get(self, key, default=None):
+        entry = self.data.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        if entry[0] < time.monotonic():
+            del self.data[key]
+            self.misses += 1
+            return default
+        self.data.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, value, ttl: Optional[float] = None):
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0:
+            return
+        self.data[key] = (time.monotonic() + ttl, value)
+        self.data.move_to_end(key)
+        while len(self.data) > self.max_entries:
+            self.data.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {"size": len(self.data), "hits": self.hits, "misses": self.misses}
+
+class BufferPool:
+    def __init__(self, size: int, keep: int):
+        self.size = size
+        self.keep = keep
+        self.free = []
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def buffer(self):
+        with self.lock:
+            buf = self.free.pop() if self.free else None
+        if buf is None:
+            buf = bytearray(self.size)
         try:
-            with yt_dlp.YoutubeDL(opts) as ydl:
-                info = ydl.extract_info(f"ytsearch1:{query}", download=False)
-                if not info or not info.get('entries'):
+            yield memoryview(buf)
+        finally:
+            with self.lock:
+                if len(self.free) < self.keep:
+                    self.free.append(buf)
+
+buffers = BufferPool(STREAM_CHUNK_SIZE, HTTP_LIMIT_PER_HOST)
+
+class HttpClient:
+    def __init__(self):
+        self.session = None
+
+    def _session(self) -> aiohttp.ClientSession:
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=HTTP_LIMIT,
+                limit_per_host=HTTP_LIMIT_PER_HOST,
+                ttl_dns_cache=HTTP_DNS_TTL,
+                keepalive_timeout=HTTP_KEEPALIVE,
+            )
+            self.session = aiohttp.ClientSession(
+                connector=connector,
+                headers={'User-Agent': 'Mozilla/5.0'},
+                timeout=aiohttp.ClientTimeout(
+                    total=HTTP_TOTAL_TIMEOUT,
+                    sock_connect=HTTP_CONNECT_TIMEOUT,
+                    sock_read=HTTP_FIRST_BYTE_TIMEOUT,
+                ),
+            )
+        return self.session
+
+    async def scan(self, url: str, scanner) -> tuple:
+        async with await self.get(url) as r:
+            r.raise_for_status()
+            decoder = codecs.getincrementaldecoder(r.charset or "utf-8")(errors="replace")
+            async for chunk in r.content.iter_any():
+                found = scanner.feed(decoder.decode(chunk))
+                if found:
+                    return found, None
+            scanner.feed(decoder.decode(b"", final=True))
+            return scanner.result, scanner.text
+
+    async def get(self, url: str, **kwargs) -> aiohttp.ClientResponse:
+        with tracer.span("HTTP GET", kind="client", **{"http.url": url.split("?")[0]}) as span:
+            r = await asyncio.wait_for(
+                self._session().get(url, **kwargs),
+                HTTP_CONNECT_TIMEOUT + HTTP_FIRST_BYTE_TIMEOUT,
+            )
+            if span:
+                span.set(**{"http.status_code": r.status})
+            return r
+
+    async def post(self, url: str, **kwargs) -> aiohttp.ClientResponse:
+        return await asyncio.wait_for(
+            self._session().post(url, **kwargs),
+            HTTP_CONNECT_TIMEOUT + HTTP_FIRST_BYTE_TIMEOUT,
+        )
+
+    async def text(self, url: str) -> str:
+        async with await self.get(url) as r:
+            r.raise_for_status()
+            return await r.text()
+
+    async def close(self):
+        if self.session and not self.session.closed:
+            await self.session.close()
+
+http = HttpClient()
+
+ZAYCEV_ITEM_CLASSES = ("musicset__item", "music-item")
+MP3_LITERAL_RE = re.compile(r'["\']([^"\'<>\s]*\.mp3[^"\'<>\s]*)["\']')
+ZAYCEV_ITEM_RE = re.compile(r'<div\b[^>]*\bclass=["\'][^"\']*\b(?:musicset__item|music-item)\b', re.I)
+ZAYCEV_LINK_RE = re.compile(r'<a\b[^>]*\bhref=["\']([^"\']*/music/[^"\']*)["\'][^>]*>(.*?)</a>', re.I | re.S)
+TAG_RE = re.compile(r"<[^>]+>")
+AUDIO_OPEN_RE = re.compile(r"<audio\b", re.I)
+AUDIO_CLOSE_RE = re.compile(r"</audio\s*>", re.I)
+AUDIO_SOURCE_RE = re.compile(r'<source\b[^>]*\bsrc=["\']([^"\'<>]*\.mp3[^"\'<>]*)["\']', re.I)
+SCAN_OVERLAP = 2048
+
+def _class_xpath(cls: str) -> str:
+    return f'contains(concat(" ", normalize-space(@class), " "), " {cls} ")'
+
+class Bs4Extractor:
+    name = "bs4"
+
+    def search_link(self, html: str) -> Optional[tuple]:
+        soup = BeautifulSoup(html, "html.parser")
+        elems = soup.select('div.musicset__item') or soup.select('div.music-item')
+        if not elems:
+            return None
+        link = elems[0].select_one('a[href*="/music/"]')
+        if not link:
+            return None
+        return link['href'], link.get_text(strip=True)
+
+    def track_mp3(self, html: str) -> Optional[str]:
+        soup = BeautifulSoup(html, "html.parser")
+        audio = soup.select_one('audio source[src*=".mp3"]')
+        if audio:
+            return audio['src']
+        data = soup.select_one('[data-url*=".mp3"]')
+        if data:
+            return data['data-url']
+        btn = soup.select_one('a[href*=".mp3"]')
+        if btn:
+            return btn['href']
+        for s in soup.find_all('script'):
+            if s.string and '.mp3' in s.string:
+                m = MP3_LITERAL_RE.search(s.string)
+                if m:
+                    return m.group(1)
+        return None
+
+class LxmlExtractor:
+    name = "lxml"
+
+    def __init__(self):
+        self.items = [etree.XPath(f'//div[{_class_xpath(cls)}]') for cls in ZAYCEV_ITEM_CLASSES]
+        self.link = etree.XPath('.//a[contains(@href, "/music/")]')
+        self.mp3 = [
+            (etree.XPath('//audio//source[contains(@src, ".mp3")]/@src'), None),
+            (etree.XPath('//*[contains(@data-url, ".mp3")]/@data-url'), None),
+            (etree.XPath('//a[contains(@href, ".mp3")]/@href'), None),
+            (etree.XPath('//script[contains(text(), ".mp3")]/text()'), MP3_LITERAL_RE),
+        ]
+
+    def search_link(self, html: str) -> Optional[tuple]:
+        doc = lxml_html.fromstring(html)
+        for xp in self.items:
+            elems = xp(doc)
+            if elems:
+                links = self.link(elems[0])
+                if not links:
                     return None
-                vid = info['entries'][0]
-                if vid.get('duration', 0) > MAX_DURATION:
-                    return "TOO_LONG"
-                ydl.download([vid['webpage_url']])
-                mp3 = f"{output}.mp3"
-                if os.path.exists(mp3):
-                    if os.path.getsize(mp3) <= MAX_FILE_SIZE:
-                        return mp3
-                    os.remove(mp3)
-                    return "TOO_BIG"
-        except Exception:
+                return links[0].get("href"), links[0].text_content().strip()
+        return None
+
+    def track_mp3(self, html: str) -> Optional[str]:
+        doc = lxml_html.fromstring(html)
+        for xp, rx in self.mp3:
+            for value in xp(doc):
+                if rx is None:
+                    return str(value)
+                m = rx.search(value)
+                if m:
+                    return m.group(1)
+        return None
+
+class SelectolaxExtractor:
+    name = "selectolax"
+
+    def search_link(self, html: str) -> Optional[tuple]:
+        tree = HTMLParser(html)
+        item = tree.css_first('div.musicset__item') or tree.css_first('div.music-item')
+        if not item:
+            return None
+        link = item.css_first('a[href*="/music/"]')
+        if not link:
             return None
+        return link.attributes.get("href"), link.text(strip=True)
+
+    def track_mp3(self, html: str) -> Optional[str]:
+        tree = HTMLParser(html)
+        for sel, attr in (('audio source[src*=".mp3"]', "src"),
+                          ('[data-url*=".mp3"]', "data-url"),
+                          ('a[href*=".mp3"]', "href")):
+            node = tree.css_first(sel)
+            if node:
+                return node.attributes.get(attr)
+        for node in tree.css("script"):
+            text = node.text()
+            if '.mp3' in text:
+                m = MP3_LITERAL_RE.search(text)
+                if m:
+                    return m.group(1)
         return None
 
-    async def search_zaycev(self, query: str) -> Optional[str]:
-        url = f"https://zaycev.net/search.html?query_search={urllib.parse.quote(query)}"
+class StreamScanner:
+    """Runs a finder over decoded chunks as they arrive.
+
+    The finder returns (result, keep): everything before `keep` has been
+    searched and is dropped from the search buffer, so each chunk is scanned
+    about once. The full page is still joined once at the end for a DOM fallback.
+    """
+
+    def __init__(self, find):
+        self.find = find
+        self.parts = []
+        self.tail = ""
+        self.result = None
+
+    @property
+    def text(self) -> str:
+        return "".join(self.parts)
+
+    def feed(self, chunk: str):
+        if self.result or not chunk:
+            return self.result
+        self.parts.append(chunk)
+        self.tail += chunk
+        self.result, keep = self.find(self.tail)
+        self.tail = self.tail[keep:]
+        return self.result
+
+class StreamExtractor:
+    """Regex scanner that can stop reading a page at the first match.
+
+    With strict=True (ZAYCEV_PARSER=auto) a track page only matches an .mp3
+    <source> inside <audio>, the first choice of the DOM backends; anything
+    else is left to the DOM fallback so the bs4 priority order is kept. The
+    standalone "stream" parser takes the first .mp3 literal on the page.
+    """
+    name = "stream"
+
+    def __init__(self, strict: bool = False):
+        self.strict = strict
+
+    @staticmethod
+    def _find_link(text: str) -> tuple:
+        item = ZAYCEV_ITEM_RE.search(text)
+        if not item:
+            return None, max(0, len(text) - SCAN_OVERLAP)
+        link = ZAYCEV_LINK_RE.search(text, item.end())
+        if not link:
+            return None, item.start()
+        title = htmlmod.unescape(TAG_RE.sub("", link.group(2))).strip()
+        return (htmlmod.unescape(link.group(1)), title), 0
+
+    @staticmethod
+    def _find_mp3(text: str) -> tuple:
+        m = MP3_LITERAL_RE.search(text)
+        if not m:
+            return None, max(0, len(text) - SCAN_OVERLAP)
+        return htmlmod.unescape(m.group(1)), 0
+
+    @staticmethod
+    def _find_audio(text: str) -> tuple:
+        pos = 0
+        while True:
+            audio = AUDIO_OPEN_RE.search(text, pos)
+            if not audio:
+                return None, max(pos, len(text) - SCAN_OVERLAP)
+            close = AUDIO_CLOSE_RE.search(text, audio.end())
+            end = close.start() if close else len(text)
+            source = AUDIO_SOURCE_RE.search(text, audio.end(), end)
+            if source:
+                return htmlmod.unescape(source.group(1)), 0
+            if not close:
+                return None, audio.start()
+            pos = close.end()
+
+    def search_scanner(self) -> StreamScanner:
+        return StreamScanner(self._find_link)
+
+    def track_scanner(self) -> StreamScanner:
+        return StreamScanner(self._find_audio if self.strict else self._find_mp3)
+
+    def search_link(self, html: str) -> Optional[tuple]:
+        return self._find_link(html)[0]
+
+    def track_mp3(self, html: str) -> Optional[str]:
+        return (self._find_audio if self.strict else self._find_mp3)(html)[0]
+
+def dom_extractor():
+    if HTMLParser is not None:
+        return SelectolaxExtractor()
+    if lxml_html is not None:
+        return LxmlExtractor()
+    return Bs4Extractor()
+
+EXTRACTORS = {
+    "bs4": Bs4Extractor,
+    "lxml": LxmlExtractor,
+    "selectolax": SelectolaxExtractor,
+    "stream": StreamExtractor,
+}
+
+def make_extractors(name: str) -> tuple:
+    if name == "auto":
+        return StreamExtractor(strict=True), dom_extractor()
+    if name not in EXTRACTORS:
+        raise ValueError(f"Unknown ZAYCEV_PARSER: {name}")
+    if (name == "lxml" and lxml_html is None) or (name == "selectolax" and HTMLParser is None):
+        raise ValueError(f"ZAYCEV_PARSER={name} requires the {name} package")
+    return EXTRACTORS[name](), None
+
+LATENCY_BUCKETS = (0.25, 0.5, 1, 2, 5, 10, 20, 30, 60, 120)
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        i = 0
+        while i < len(self.buckets) and value > self.buckets[i]:
+            i += 1
+        self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if seen >= rank:
+                return self.buckets[i] if i < len(self.buckets) else float("inf")
+        return float("inf")
+
+def _label_value(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_label_value(v)}"' for k, v in labels) + "}"
+
+def _number(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+class Metrics:
+    """Counters and histograms exposed in the Prometheus text format on /metrics."""
+
+    def __init__(self, prefix: str):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.kinds = {}
+        self.helps = {}
+        self.values = defaultdict(float)
+        self.histograms = {}
+        self.collectors = []
+
+    def describe(self, name: str, kind: str, text: str):
+        self.kinds[name] = kind
+        self.helps[name] = text
+
+    def inc(self, name: str, value: float = 1, **labels):
+        with self.lock:
+            self.values[name, tuple(sorted(labels.items()))] += value
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            h = self.histograms.get(key)
+            if h is None:
+                h = self.histograms[key] = Histogram()
+            h.observe(value)
+
+    @contextlib.contextmanager
+    def timer(self, name: str, **labels):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - started, **labels)
+
+    def collect(self, func):
+        self.collectors.append(func)
+        return func
+
+    def render(self) -> str:
+        samples = defaultdict(list)
+        hists = defaultdict(list)
+        with self.lock:
+            for (name, labels), v in self.values.items():
+                samples[name].append((labels, v))
+            for (name, labels), h in self.histograms.items():
+                hists[name].append((labels, h.buckets, list(h.counts), h.sum, h.count))
+        for func in self.collectors:
+            for name, labels, v in func():
+                samples[name].append((tuple(sorted(labels.items())), v))
+        lines = []
+        for name in sorted(set(samples) | set(hists)):
+            full = self.prefix + name
+            if name in self.helps:
+                lines.append(f"# HELP {full} {self.helps[name]}")
+            lines.append(f"# TYPE {full} {self.kinds.get(name, 'untyped')}")
+            for labels, v in sorted(samples.get(name, ())):
+                lines.append(f"{full}{_labels(labels)} {_number(v)}")
+            for labels, buckets, counts, total, count in sorted(hists.get(name, ()), key=lambda h: h[0]):
+                seen = 0
+                for le, c in zip(buckets + (float("inf"),), counts):
+                    seen += c
+                    lines.append(f"{full}_bucket{_labels(labels + (('le', _number(le)),))} {seen}")
+                lines.append(f"{full}_sum{_labels(labels)} {_number(total)}")
+                lines.append(f"{full}_count{_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics("musicbot_")
+for _name, _kind, _text in (
+    ("queue_wait_seconds", "histogram", "Time a request waited for a download slot."),
+    ("stage_seconds", "histogram", "Time spent in each pipeline stage, per source."),
+    ("pool_wait_seconds", "histogram", "Time a call waited for a free executor thread."),
+    ("requests_total", "counter", "Search requests by outcome and source."),
+    ("errors_total", "counter", "Failures by stage, source and exception type."),
+    ("cache_hits_total", "counter", "Cache hits per cache."),
+    ("cache_misses_total", "counter", "Cache misses per cache."),
+    ("cache_entries", "gauge", "Entries held per cache."),
+    ("jobs", "gauge", "Download jobs by state."),
+    ("pool_threads", "gauge", "Executor threads by stage and state."),
+    ("workspace_bytes", "gauge", "Temporary disk usage, admitted jobs' commitment and quota."),
+    ("workspace_reclaimed_bytes_total", "counter", "Bytes removed from the workspace by cleanup and sweeps."),
+    ("workspace_jobs", "gauge", "Workspace job directories in use and jobs waiting for admission."),
+):
+    metrics.describe(_name, _kind, _text)
+
+current_source = contextvars.ContextVar("current_source", default="")
+current_span = contextvars.ContextVar("current_span", default=None)
+
+def record_failure(stage: str, source: str, e: BaseException):
+    logger.warning(f"{source or 'request'} {stage} failed: {e!r}")
+    metrics.inc("errors_total", stage=stage, source=source, type=type(e).__name__)
+    span = current_span.get()
+    if span:
+        span.fail(e)
+
+SPAN_KINDS = {"internal": 1, "server": 2, "client": 3, "producer": 4, "consumer": 5}
+
+class Span:
+    __slots__ = ("trace", "span_id", "parent_id", "name", "kind", "start", "end", "attributes", "events", "error")
+
+    def __init__(self, trace, name: str, parent_id: Optional[str], kind: str, attributes: dict):
+        self.trace = trace
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = SPAN_KINDS[kind]
+        self.start = time.time_ns()
+        self.end = None
+        self.attributes = attributes
+        self.events = []
+        self.error = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def fail(self, e: BaseException):
+        self.error = f"{type(e).__name__}: {e}"
+        self.events.append(("exception", time.time_ns(),
+                            {"exception.type": type(e).__name__, "exception.message": str(e)}))
+
+    def finish(self):
+        if self.end is None:
+            self.end = time.time_ns()
+            self.trace.finished(self)
+
+    def traceparent(self) -> str:
+        return f"00-{self.trace.trace_id}-{self.span_id}-{'01' if self.trace.sampled else '00'}"
+
+class Trace:
+    __slots__ = ("tracer", "trace_id", "sampled", "spans", "root")
+
+    def __init__(self, tracer, trace_id: str, sampled: bool):
+        self.tracer = tracer
+        self.trace_id = trace_id
+        self.sampled = sampled
+        self.spans = []
+        self.root = None
+
+    def finished(self, span: Span):
+        self.spans.append(span)
+        if span is self.root:
+            self.tracer.complete(self)
+
+def _otlp_value(value) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+def _otlp_attributes(attributes: dict) -> list:
+    return [{"key": k, "value": _otlp_value(v)} for k, v in attributes.items() if v is not None]
+
+class Tracer:
+    """Per-request spans exported as OTLP/JSON to a file (one batch per line) or a collector.
+
+    A trace is kept when its root was head-sampled at `rate`, or when the root took longer than
+    `slow` seconds, so slow requests are always available for analysis.
+    """
+
+    def __init__(self, rate: float, slow: float, path: str, endpoint: str, service: str, buffer: int):
+        self.rate = rate
+        self.slow = slow
+        self.path = path
+        self.endpoint = endpoint
+        self.enabled = (rate > 0 or slow > 0) and bool(path or endpoint)
+        self.resource = _otlp_attributes({"service.name": service, "host.name": socket.gethostname(),
+                                          "process.pid": os.getpid()})
+        self.lock = threading.Lock()
+        self.pending = deque(maxlen=buffer)
+        self.exported = 0
+        self.dropped = 0
+
+    def start(self, name: str, root: bool = False, traceparent: Optional[str] = None,
+              kind: str = "internal", **attributes) -> Optional[Span]:
+        if not self.enabled:
+            return None
+        parent = current_span.get()
+        if traceparent:
+            _, trace_id, parent_id, flags = traceparent.split("-")
+            trace = Trace(self, trace_id, flags == "01")
+        elif root:
+            rid = current_request.get()
+            trace_id = rid if len(rid) == 32 else os.urandom(16).hex()
+            trace, parent_id = Trace(self, trace_id, random.random() < self.rate), None
+        elif parent is not None:
+            trace, parent_id = parent.trace, parent.span_id
+        else:
+            return None
+        span = Span(trace, name, parent_id, kind, attributes)
+        if trace.root is None:
+            trace.root = span
+        return span
+
+    @contextlib.contextmanager
+    def span(self, name: str, root: bool = False, traceparent: Optional[str] = None,
+             kind: str = "internal", **attributes):
+        span = self.start(name, root, traceparent, kind, **attributes)
+        if span is None:
+            yield None
+            return
+        token = current_span.set(span)
         try:
-            r = self.session.get(url, timeout=20); r.raise_for_status()
-            soup = BeautifulSoup(r.text, "html.parser")
-            elems = soup.select('div.musicset__item') or soup.select('div.music-item')
-            if not elems:
+            yield span
+        except asyncio.CancelledError:
+            span.set(cancelled=True)
+            raise
+        except BaseException as e:
+            span.fail(e)
+            raise
+        finally:
+            current_span.reset(token)
+            span.finish()
+
+    def complete(self, trace: Trace):
+        root = trace.root
+        if not trace.sampled and not (self.slow and (root.end - root.start) / 1e9 >= self.slow):
+            return
+        with self.lock:
+            if len(self.pending) == self.pending.maxlen:
+                self.dropped += 1
+            self.pending.append(trace.spans)
+
+    def otlp(self, batch: list) -> dict:
+        spans = []
+        for trace_spans in batch:
+            for sp in trace_spans:
+                out = {
+                    "traceId": sp.trace.trace_id,
+                    "spanId": sp.span_id,
+                    "name": sp.name,
+                    "kind": sp.kind,
+                    "startTimeUnixNano": str(sp.start),
+                    "endTimeUnixNano": str(sp.end),
+                    "attributes": _otlp_attributes(sp.attributes),
+                    "status": {"code": 2, "message": sp.error} if sp.error else {"code": 0},
+                }
+                if sp.parent_id:
+                    out["parentSpanId"] = sp.parent_id
+                if sp.events:
+                    out["events"] = [{"name": n, "timeUnixNano": str(t), "attributes": _otlp_attributes(a)}
+                                     for n, t, a in sp.events]
+                spans.append(out)
+        return {"resourceSpans": [{
+            "resource": {"attributes": self.resource},
+            "scopeSpans": [{"scope": {"name": "music_bot"}, "spans": spans}],
+        }]}
+
+    async def flush(self):
+        with self.lock:
+            batch = list(self.pending)
+            self.pending.clear()
+        if not batch:
+            return
+        body = json.dumps(self.otlp(batch), ensure_ascii=False, separators=(",", ":"))
+        try:
+            if self.path:
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(body + "\n")
+            if self.endpoint:
+                async with await http.post(self.endpoint, data=body.encode(),
+                                           headers={"Content-Type": "application/json"}) as r:
+                    r.raise_for_status()
+            self.exported += len(batch)
+        except Exception as e:
+            self.dropped += len(batch)
+            logger.warning(f"Trace export failed: {e!r}")
+
+    async def exporter(self, interval: float):
+        try:
+            while True:
+                await asyncio.sleep(interval)
+                await self.flush()
+        finally:
+            await self.flush()
+
+tracer = Tracer(TRACE_SAMPLE_RATE, TRACE_SLOW_SECONDS, TRACE_FILE, TRACE_ENDPOINT, TRACE_SERVICE, TRACE_BUFFER)
+
+class ExecutionEngine:
+    def __init__(self, sizes: dict):
+        self.lock = threading.Lock()
+        self.pools = {}
+        self.counters = {}
+        for stage, size in sizes.items():
+            self.pools[stage] = ThreadPoolExecutor(max_workers=size, thread_name_prefix=f"mb-{stage}")
+            self.counters[stage] = {"workers": size, "queued": 0, "active": 0, "done": 0, "failed": 0}
+
+    def _bump(self, stage: str, **delta):
+        with self.lock:
+            c = self.counters[stage]
+            for k, v in delta.items():
+                c[k] += v
+
+    async def run(self, stage: str, func, *args):
+        ctx = contextvars.copy_context()
+        source = current_source.get()
+        submitted = time.monotonic()
+
+        def traced(wait):
+            with tracer.span(stage, source=source, pool_wait_ms=round(wait * 1000, 1)):
+                return func(*args)
+
+        def call():
+            self._bump(stage, queued=-1, active=1)
+            started = time.monotonic()
+            metrics.observe("pool_wait_seconds", started - submitted, stage=stage)
+            try:
+                return ctx.run(traced, started - submitted)
+            except BaseException:
+                self._bump(stage, failed=1)
+                raise
+            finally:
+                self._bump(stage, active=-1, done=1)
+                metrics.observe("stage_seconds", time.monotonic() - started, stage=stage, source=source)
+
+        def on_done(fut):
+            if fut.cancelled():
+                self._bump(stage, queued=-1)
+
+        self._bump(stage, queued=1)
+        fut = self.pools[stage].submit(call)
+        fut.add_done_callback(on_done)
+        return await asyncio.wrap_future(fut)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {stage: dict(c) for stage, c in self.counters.items()}
+
+    def shutdown(self):
+        for pool in self.pools.values():
+            pool.shutdown(wait=False, cancel_futures=True)
+
+engine = ExecutionEngine({
+    "extract": EXTRACT_WORKERS,
+    "download": DOWNLOAD_WORKERS,
+    "parse": PARSE_WORKERS,
+    "transcode": TRANSCODE_WORKERS,
+})
+
+class FileIdCache:
+    def __init__(self, path: str, ttl: int, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.invalidated = 0
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS file_ids ("
+            "key TEXT PRIMARY KEY, file_id TEXT NOT NULL, source TEXT NOT NULL, "
+            "created REAL NOT NULL, used REAL NOT NULL)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS file_ids_used ON file_ids(used)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS file_ids_file_id ON file_ids(file_id)")
+
+    def get(self, *keys) -> Optional[tuple]:
+        now = time.time()
+        with self.lock:
+            for key in keys:
+                if not key:
+                    continue
+                row = self.db.execute(
+                    "SELECT file_id, source, created FROM file_ids WHERE key = ?", (key,)
+                ).fetchone()
+                if not row:
+                    continue
+                if now - row[2] > self.ttl:
+                    self.db.execute("DELETE FROM file_ids WHERE key = ?", (key,))
+                    continue
+                self.db.execute("UPDATE file_ids SET used = ? WHERE key = ?", (now, key))
+                self.hits += 1
+                return row[0], row[1]
+            self.misses += 1
+            return None
+
+    def put(self, file_id: str, source: str, *keys):
+        now = time.time()
+        with self.lock:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO file_ids (key, file_id, source, created, used) VALUES (?, ?, ?, ?, ?)",
+                [(key, file_id, source, now, now) for key in keys if key],
+            )
+            excess = self.db.execute("SELECT COUNT(*) FROM file_ids").fetchone()[0] - self.max_entries
+            if excess > 0:
+                self.db.execute(
+                    "DELETE FROM file_ids WHERE key IN (SELECT key FROM file_ids ORDER BY used LIMIT ?)",
+                    (excess,),
+                )
+
+    def invalidate(self, file_id: str):
+        with self.lock:
+            self.invalidated += 1
+            self.db.execute("DELETE FROM file_ids WHERE file_id = ?", (file_id,))
+
+    def stats(self) -> dict:
+        with self.lock:
+            size = self.db.execute("SELECT COUNT(*) FROM file_ids").fetchone()[0]
+            return {"size": size, "hits": self.hits, "misses": self.misses, "invalidated": self.invalidated}
+
+file_cache = FileIdCache(FILE_CACHE_PATH, FILE_CACHE_TTL, FILE_CACHE_SIZE)
+
+class SchedulerFull(Exception):
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+class Ticket:
+    __slots__ = ("chat_id", "future", "on_position", "position", "shown", "shown_at", "timer")
+
+    def __init__(self, chat_id: int, on_position):
+        self.chat_id = chat_id
+        self.future = asyncio.get_running_loop().create_future()
+        self.on_position = on_position
+        self.position = None
+        self.shown = None
+        self.shown_at = float("-inf")
+        self.timer = None
+
+class DownloadScheduler:
+    def __init__(self, max_active: int, per_user: int, max_queued: int, notify_interval: float = 0):
+        self.max_active = max_active
+        self.per_user = per_user
+        self.max_queued = max_queued
+        self.notify_interval = notify_interval
+        self.active = 0
+        self.queued = 0
+        self.inflight = defaultdict(int)
+        self.queues = OrderedDict()
+        self.shed = 0
+
+    @contextlib.asynccontextmanager
+    async def slot(self, chat_id: int, user_id: int, on_position=None):
+        if self.inflight.get(user_id, 0) >= self.per_user:
+            self.shed += 1
+            raise SchedulerFull("user_busy")
+        if self.active >= self.max_active and self.queued >= self.max_queued:
+            self.shed += 1
+            raise SchedulerFull("queue_full")
+        self.inflight[user_id] += 1
+        try:
+            started = time.monotonic()
+            if self.active < self.max_active and not self.queued:
+                self.active += 1
+            else:
+                with tracer.span("queue wait", chat_id=chat_id, queued=self.queued):
+                    await self._wait(Ticket(chat_id, on_position))
+            metrics.observe("queue_wait_seconds", time.monotonic() - started, queue="local")
+            try:
+                yield
+            finally:
+                self.active -= 1
+                self._dispatch()
+        finally:
+            self.inflight[user_id] -= 1
+            if not self.inflight[user_id]:
+                del self.inflight[user_id]
+
+    async def _wait(self, ticket: Ticket):
+        self.queues.setdefault(ticket.chat_id, deque()).append(ticket)
+        self.queued += 1
+        self._notify()
+        try:
+            await ticket.future
+        except asyncio.CancelledError:
+            if ticket.future.done() and not ticket.future.cancelled():
+                self.active -= 1
+                self._dispatch()
+            else:
+                self._drop(ticket)
+            raise
+
+    def _drop(self, ticket: Ticket):
+        dq = self.queues.get(ticket.chat_id)
+        if dq and ticket in dq:
+            dq.remove(ticket)
+            self.queued -= 1
+            if not dq:
+                del self.queues[ticket.chat_id]
+            self._notify()
+
+    def _dispatch(self):
+        while self.active < self.max_active and self.queues:
+            chat_id, dq = next(iter(self.queues.items()))
+            ticket = dq.popleft()
+            self.queued -= 1
+            if dq:
+                self.queues.move_to_end(chat_id)
+            else:
+                del self.queues[chat_id]
+            # Cancelled but not yet resumed: its waiter will find it gone and just return
+            if ticket.future.done():
+                continue
+            self.active += 1
+            ticket.future.set_result(None)
+        self._notify()
+
+    def _order(self):
+        rounds = max((len(dq) for dq in self.queues.values()), default=0)
+        for r in range(rounds):
+            for dq in self.queues.values():
+                if r < len(dq):
+                    yield dq[r]
+
+    def _notify(self):
+        for pos, ticket in enumerate(self._order(), 1):
+            if ticket.position != pos:
+                ticket.position = pos
+                self._announce(ticket)
+
+    def _announce(self, ticket: Ticket):
+        # Every finished job shifts the whole queue; edit each ticket at most once per
+        # notify_interval and fold the positions in between into one delayed edit
+        if not ticket.on_position or ticket.timer or ticket.future.done() or ticket.position == ticket.shown:
+            return
+        loop = asyncio.get_running_loop()
+        delay = ticket.shown_at + self.notify_interval - loop.time()
+        if delay > 0:
+            ticket.timer = loop.call_later(delay, self._flush, ticket)
+            return
+        ticket.shown, ticket.shown_at = ticket.position, loop.time()
+        task = asyncio.ensure_future(ticket.on_position(ticket.position))
+        task.add_done_callback(self._notified)
+
+    def _flush(self, ticket: Ticket):
+        ticket.timer = None
+        self._announce(ticket)
+
+    @staticmethod
+    def _notified(task: asyncio.Task):
+        if not task.cancelled() and task.exception():
+            record_failure("notify", "queue", task.exception())
+
+    def stats(self) -> dict:
+        return {
+            "active": self.active,
+            "queued": self.queued,
+            "chats": len(self.queues),
+            "shed": self.shed,
+            "max_active": self.max_active,
+        }
+
+scheduler = DownloadScheduler(MAX_ACTIVE_JOBS, PER_USER_JOBS, MAX_QUEUED_JOBS, QUEUE_NOTIFY_INTERVAL)
+
+class Flight:
+    def __init__(self):
+        self.task = None
+        self.refs = 0
+        self.keys = []
+        self.watchers = []
+        self.stack = contextlib.AsyncExitStack()
+        self.upload_lock = asyncio.Lock()
+        self.file_id = None
+        self.waiting = None
+
+class SingleFlight:
+    def __init__(self):
+        self.flights = {}
+        self.started = 0
+        self.joined = 0
+
+    def get(self, key: str) -> Optional[Flight]:
+        return self.flights.get(key)
+
+    def alias(self, flight: Flight, key: str):
+        if key not in self.flights:
+            self.flights[key] = flight
+            flight.keys.append(key)
+
+    def forget(self, flight: Flight):
+        for key in flight.keys:
+            if self.flights.get(key) is flight:
+                del self.flights[key]
+        flight.keys.clear()
+
+    async def _notify(self, flight: Flight, *args):
+        for cb in list(flight.watchers):
+            with contextlib.suppress(Exception):
+                await cb(*args)
+
+    @contextlib.asynccontextmanager
+    async def join(self, key: str, factory=None, watcher=None):
+        flight = self.flights.get(key)
+        if flight is None:
+            flight = Flight()
+            self.alias(flight, key)
+            flight.task = asyncio.ensure_future(factory(flight, lambda *a: self._notify(flight, *a)))
+            self.started += 1
+        else:
+            self.joined += 1
+        flight.refs += 1
+        if watcher:
+            flight.watchers.append(watcher)
+        try:
+            yield await asyncio.shield(flight.task)
+        finally:
+            if watcher:
+                flight.watchers.remove(watcher)
+            flight.refs -= 1
+            if not flight.refs:
+                self.forget(flight)
+                if not flight.task.done():
+                    flight.task.cancel()
+                    with contextlib.suppress(BaseException):
+                        await flight.task
+                await flight.stack.aclose()
+
+    def stats(self) -> dict:
+        return {"inflight": len({id(f) for f in self.flights.values()}),
+                "started": self.started, "joined": self.joined}
+
+flights = SingleFlight()
+
+def run_ffmpeg(args: list) -> float:
+    with tracer.span("ffmpeg", args=" ".join(a for a in args if not os.path.isabs(a))) as span:
+        proc = subprocess.Popen(["ffmpeg", "-hide_banner", "-loglevel", "error", "-nostdin", "-y", *args],
+                                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        err = proc.stderr.read()
+        proc.stderr.close()
+        _, status, usage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        if span:
+            span.set(exit_code=proc.returncode, cpu_seconds=round(usage.ru_utime + usage.ru_stime, 3))
+        if proc.returncode:
+            raise RuntimeError(f"ffmpeg exited with {proc.returncode}: {err.decode(errors='replace')[-300:]}")
+        return usage.ru_utime + usage.ru_stime
+
+class TranscodePolicy:
+    NATIVE = {"mp3": ("mp3",), "m4a": ("mp4a", "aac")}
+    REMUX = {"mp4a": "m4a", "aac": "m4a", "mp3": "mp3"}
+
+    def __init__(self, mode: str, max_bitrate: int, threads: int):
+        if mode not in ("auto", "remux", "transcode"):
+            raise ValueError(f"Unknown TRANSCODE_POLICY: {mode}")
+        self.mode = mode
+        self.max_bitrate = max_bitrate
+        self.threads = threads
+        self.counts = defaultdict(int)
+        self.cpu = defaultdict(float)
+
+    def bitrate(self, duration: int) -> int:
+        if not duration:
+            return self.max_bitrate
+        return min(self.max_bitrate, int(MAX_FILE_SIZE * 8 * 0.95 / duration / 1000))
+
+    def _record(self, choice: str, cpu: float, src: str, out: str):
+        self.counts[choice] += 1
+        self.cpu[choice] += cpu
+        logger.info(f"Audio {choice}: {os.path.basename(src)} -> {os.path.basename(out)}, "
+                    f"{os.path.getsize(out)} bytes, {cpu:.2f} CPU-s")
+
+    def choice(self, ext: str, acodec: str, size: Optional[int]) -> str:
+        codec = (acodec or "").split(".")[0].lower()
+        fits = size is None or size <= MAX_FILE_SIZE
+        if self.mode == "auto" and ext in self.NATIVE and codec.startswith(self.NATIVE[ext]) and fits:
+            return "native"
+        if self.mode != "transcode" and codec in self.REMUX and fits:
+            return "remux"
+        return "transcode"
+
+    def apply(self, src: str, acodec: str, duration: int, out_base: str) -> str:
+        codec = (acodec or "").split(".")[0].lower()
+        choice = self.choice(src.rsplit(".", 1)[-1].lower(), acodec, os.path.getsize(src))
+        if choice == "native":
+            self._record("native", 0.0, src, src)
+            return src
+        if choice == "remux":
+            out = f"{out_base}.{self.REMUX[codec]}"
+            try:
+                cpu = run_ffmpeg(["-i", src, "-vn", "-map_metadata", "0", "-c:a", "copy",
+                                  "-movflags", "+faststart", out])
+                self._record("remux", cpu, src, out)
+                return out
+            except RuntimeError as e:
+                logger.warning(f"Remux failed, transcoding instead: {e}")
+        kbps = self.bitrate(duration)
+        if kbps < 32:
+            return "TOO_BIG"
+        out = f"{out_base}.mp3"
+        cpu = run_ffmpeg(["-i", src, "-vn", "-map_metadata", "0", "-c:a", "libmp3lame",
+                          "-b:a", f"{kbps}k", "-threads", str(self.threads), out])
+        self._record(f"transcode@{kbps}k", cpu, src, out)
+        return out
+
+    def stats(self) -> dict:
+        return {k: {"count": self.counts[k], "cpu": round(self.cpu[k], 2)} for k in self.counts}
+
+transcoder = TranscodePolicy(TRANSCODE_POLICY, TRANSCODE_BITRATE, TRANSCODE_THREADS)
+
+class PipeInputFile(InputFile):
+    def __init__(self, url: str, headers: dict, kbps: int, filename: str, limit: int):
+        super().__init__(filename=filename, chunk_size=STREAM_CHUNK_SIZE)
+        self.url = url
+        self.headers = headers
+        self.kbps = kbps
+        self.limit = limit
+        self.sent = 0
+        self.too_big = False
+
+    async def _feed(self, proc):
+        try:
+            async with await http.get(self.url, headers=self.headers) as r:
+                r.raise_for_status()
+                async for chunk in r.content.iter_chunked(self.chunk_size):
+                    proc.stdin.write(chunk)
+                    await proc.stdin.drain()
+        finally:
+            with contextlib.suppress(Exception):
+                proc.stdin.close()
+
+    async def read(self, bot) -> AsyncGenerator[bytes, None]:
+        started = time.monotonic()
+        span = tracer.start("ffmpeg stream", kbps=self.kbps)
+        proc = await asyncio.create_subprocess_exec(
+            "ffmpeg", "-hide_banner", "-loglevel", "error", "-i", "pipe:0", "-vn",
+            "-c:a", "libmp3lame", "-b:a", f"{self.kbps}k", "-threads", str(TRANSCODE_THREADS),
+            "-f", "mp3", "pipe:1",
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+        )
+        feeder = asyncio.ensure_future(self._feed(proc))
+        try:
+            while True:
+                chunk = await proc.stdout.read(self.chunk_size)
+                if not chunk:
+                    break
+                self.sent += len(chunk)
+                if self.sent > self.limit:
+                    self.too_big = True
+                    raise ValueError(f"Streamed audio exceeds {self.limit} bytes")
+                yield chunk
+            await feeder
+            if await proc.wait():
+                raise RuntimeError(f"ffmpeg exited with {proc.returncode}")
+            logger.info(f"Audio stream@{self.kbps}k: {self.filename}, {self.sent} bytes "
+                        f"in {time.monotonic() - started:.1f}s")
+        except Exception as e:
+            if span:
+                span.fail(e)
+            raise
+        finally:
+            if span:
+                span.set(bytes=self.sent, exit_code=proc.returncode)
+                span.finish()
+            feeder.cancel()
+            if proc.returncode is None:
+                proc.kill()
+                await proc.wait()
+
+class AudioStream:
+    def __init__(self, cand: Candidate, kbps: int):
+        self.cand = cand
+        self.kbps = kbps
+
+    def input_file(self) -> PipeInputFile:
+        name = " ".join(re.sub(r'[\\/:*?"<>|]+', " ", self.cand.title or self.cand.id).split()) or "audio"
+        return PipeInputFile(self.cand.url, self.cand.info.get('http_headers') or {},
+                             self.kbps, f"{name[:60]}.mp3", MAX_FILE_SIZE)
+
+class MultiSourceDownloader:
+    def __init__(self):
+        self.ydl_opts = {
+            "youtube": {
+                'format': 'bestaudio[ext=m4a]/bestaudio/best',
+                'quiet': True,
+                'socket_timeout': 30,
+                'cookiefile': 'youtube_cookies.txt'
+            },
+            "alternative": {
+                'format': 'bestaudio/best',
+                'quiet': True
+            },
+            "search": {
+                'quiet': True,
+                'extract_flat': 'in_playlist',
+                'skip_download': True,
+                'socket_timeout': 30,
+            },
+        }
+        self.sources = (
+            ("YouTube", "searching_youtube", self.resolve_youtube, self.fetch_ydl),
+            ("Zaycev.net", "searching_zaycev", self.resolve_zaycev, self.fetch_zaycev),
+            ("Alternative", "searching_alternative", self.resolve_alternative, self.fetch_ydl),
+        )
+        self.source_stats = {
+            name: {"attempts": 0, "wins": 0, "cancelled": 0, "latency": Histogram()} for name, *_ in self.sources
+        }
+        self.resolved = TTLCache(RESOLVE_CACHE_TTL, RESOLVE_CACHE_SIZE)
+        self.search_results = TTLCache(RESOLVE_CACHE_TTL, RESOLVE_CACHE_SIZE)
+        self.extractor, self.fallback_extractor = make_extractors(ZAYCEV_PARSER)
+        self.zaycev_search = TTLCache(ZAYCEV_SEARCH_TTL, ZAYCEV_CACHE_SIZE)
+        self.zaycev_tracks = TTLCache(ZAYCEV_TRACK_TTL, ZAYCEV_CACHE_SIZE)
+
+    def _known(self, job: Job, track_id: str) -> bool:
+        job.track_id = track_id
+        cached = file_cache.get(track_id)
+        if cached:
+            job.file_id = cached[0]
+            return True
+        return False
+
+    async def _cached_resolve(self, kind: str, query: str, func, exact: bool = False) -> Optional[Candidate]:
+        key = f"{kind}:{query if exact else normalize_query(query)}"
+        cand = self.resolved.get(key)
+        if cand is not None:
+            return cand
+        cand = await func(query)
+        if cand:
+            ttl = cand.expires - time.time() - 60 if cand.expires else None
+            self.resolved.put(key, cand, ttl)
+        return cand
+
+    def _ydl_candidate(self, kind: str, search: str) -> Optional[Candidate]:
+        with yt_dlp.YoutubeDL(self.ydl_opts[kind]) as ydl:
+            info = ydl.extract_info(search, download=False)
+        if not info:
+            return None
+        if 'entries' in info:
+            if not info['entries']:
                 return None
-            link = elems[0].select_one('a[href*="/music/"]')
-            if not link:
+            info = info['entries'][0]
+        vid = info
+        return Candidate(
+            source=vid.get('extractor_key', 'youtube').lower(),
+            id=vid['id'],
+            title=vid.get('title', ''),
+            duration=vid.get('duration', 0),
+            filesize=vid.get('filesize') or vid.get('filesize_approx'),
+            url=vid.get('url'),
+            expires=url_expiry(vid.get('url')),
+            info=dict(compact_info(vid), __ydl_kind=kind),
+        )
+
+    async def resolve_youtube(self, query: str) -> Optional[Candidate]:
+        async def resolve(q):
+            try:
+                return await engine.run("extract", self._ydl_candidate, "youtube", f"ytsearch1:{q}")
+            except Exception as e:
+                record_failure("search", "YouTube", e)
                 return None
-            track_url = "https://zaycev.net" + link['href']
-            r2 = self.session.get(track_url, timeout=20); r2.raise_for_status()
-            soup2 = BeautifulSoup(r2.text, "html.parser")
-            dl = None
-            audio = soup2.select_one('audio source[src*=".mp3"]')
-            if audio:
-                dl = audio['src']
-            if not dl:
-                data = soup2.select_one('[data-url*=".mp3"]')
-                if data:
-                    dl = data['data-url']
-            if not dl:
-                btn = soup2.select_one('a[href*=".mp3"]')
-                if btn:
-                    dl = btn['href']
-            if not dl:
-                for s in soup2.find_all('script'):
-                    if s.string and '.mp3' in s.string:
-                        m = re.findall(r'["\']([^"\']*\.mp3[^"\']*)["\']', s.string)
-                        if m:
-                            dl = m[0]
-                            break
+        return await self._cached_resolve("youtube", query, resolve)
+
+    async def resolve_alternative(self, query: str) -> Optional[Candidate]:
+        async def resolve(q):
+            for search in (f"ytsearch1:{q} site:soundcloud.com",
+                           f"ytsearch1:{q} audio"):
+                try:
+                    cand = await engine.run("extract", self._ydl_candidate, "alternative", search)
+                    if cand and cand.duration <= MAX_DURATION:
+                        return cand
+                except Exception as e:
+                    record_failure("search", "Alternative", e)
+                await asyncio.sleep(1)
+            return None
+        return await self._cached_resolve("alternative", query, resolve)
+
+    def _ydl_search(self, query: str, n: int) -> tuple:
+        with yt_dlp.YoutubeDL(self.ydl_opts["search"]) as ydl:
+            info = ydl.extract_info(f"ytsearch{n}:{query}", download=False)
+        return tuple(
+            (e['id'], (e.get('title') or e['id'])[:64], int(e.get('duration') or 0))
+            for e in (info or {}).get('entries') or () if e and e.get('id')
+        )
+
+    async def search(self, query: str, n: int) -> tuple:
+        """Top-n YouTube results as (id, title, duration) from one flat search, without formats."""
+        key = f"{n}:{normalize_query(query)}"
+        found = self.search_results.get(key)
+        if found is None:
+            current_source.set("YouTube")
+            with metrics.timer("stage_seconds", stage="search", source="YouTube picker"):
+                found = await engine.run("extract", self._ydl_search, query, n)
+            self.search_results.put(key, found, None if found else PICKER_NEGATIVE_TTL)
+        return found
+
+    async def resolve_video(self, video_id: str) -> Optional[Candidate]:
+        async def resolve(vid):
+            try:
+                return await engine.run("extract", self._ydl_candidate, "youtube",
+                                        f"https://www.youtube.com/watch?v={vid}")
+            except Exception as e:
+                record_failure("search", "YouTube", e)
+                return None
+        # Video ids are case-sensitive and may contain "-", so they are used as is
+        return await self._cached_resolve("video", video_id, resolve, exact=True)
+
+    async def download_picked(self, video_id: str, job: Job) -> (Optional[str], str):
+        i = next(i for i, s in enumerate(self.sources) if s[0] == "YouTube")
+        cand = await self._attempt("YouTube", self.resolve_video, video_id)
+        if not cand:
+            return None, "nowhere"
+        return await self._deliver(i, cand, job), "YouTube"
+
+    async def resolve_zaycev(self, query: str) -> Optional[Candidate]:
+        return await self._cached_resolve("zaycev", query, self._zaycev_resolve)
+
+    async def _zaycev_resolve(self, query: str) -> Optional[Candidate]:
+        url = f"{ZAYCEV_URL}/search.html?query_search={urllib.parse.quote(query)}"
+        try:
+            key = normalize_query(query)
+            found = self.zaycev_search.get(key)
+            if found is None:
+                found = await self._extract(url, "search")
+                self.zaycev_search.put(key, found or False, None if found else ZAYCEV_NEGATIVE_TTL)
+            if not found:
+                return None
+            href, title = found
+            dl = self.zaycev_tracks.get(href)
+            if dl is None:
+                dl = await self._extract(ZAYCEV_URL + href, "track")
+                if dl and dl.startswith('//'):
+                    dl = 'https:' + dl
+                if dl and dl.startswith('/'):
+                    dl = ZAYCEV_URL + dl
+                if dl:
+                    expires = url_expiry(dl)
+                    self.zaycev_tracks.put(href, dl, expires - time.time() - 60 if expires else None)
+                else:
+                    self.zaycev_tracks.put(href, False, ZAYCEV_NEGATIVE_TTL)
             if not dl:
                 return None
-            if dl.startswith('//'):
-                dl = 'https:' + dl
-            if dl.startswith('/'):
-                dl = 'https://zaycev.net' + dl
-            tmp = os.path.join(TEMP_DIR, f"z_{int(time.time())}.mp3")
-            ar = self.session.get(dl, timeout=30, stream=True); ar.raise_for_status()
-            ct = ar.headers.get('content-type','')
-            if 'audio' not in ct:
+            return Candidate("zaycev", href, title=title, url=dl, expires=url_expiry(dl))
+        except Exception as e:
+            record_failure("search", "Zaycev.net", e)
+            return None
+
+    async def _extract(self, url: str, kind: str):
+        ex = self.extractor
+        if isinstance(ex, StreamExtractor):
+            scanner = ex.search_scanner() if kind == "search" else ex.track_scanner()
+            found, text = await http.scan(url, scanner)
+            if found or self.fallback_extractor is None:
+                return found
+            ex = self.fallback_extractor
+        else:
+            text = await http.text(url)
+        func = ex.search_link if kind == "search" else ex.track_mp3
+        return await engine.run("parse", func, text)
+
+    def _cancel_hook(self, job: Job):
+        def hook(d):
+            if job.cancelled.is_set():
+                raise yt_dlp.utils.DownloadCancelled()
+        return hook
+
+    async def fetch_ydl(self, cand: Candidate, job: Job, stream: bool = True) -> Optional[str]:
+        if stream and STREAM_UPLOAD and not BOT_API_LOCAL and cand.url and cand.duration:
+            ext, acodec = cand.info.get('ext', ''), cand.info.get('acodec')
+            if transcoder.choice(ext, acodec, cand.filesize) == "transcode":
+                kbps = transcoder.bitrate(cand.duration)
+                if kbps < 32:
+                    return "TOO_BIG"
+                transcoder.counts[f"stream@{kbps}k"] += 1
+                return AudioStream(cand, kbps)
+        try:
+            src, acodec = await engine.run("download", self._download_ydl_sync, cand, job)
+            if not src or job.cancelled.is_set():
                 return None
-            with open(tmp, 'wb') as f:
-                for c in ar.iter_content(8192):
-                    f.write(c)
-            sz = os.path.getsize(tmp)
-            if sz < 1000:
-                os.remove(tmp)
+            res = await engine.run("transcode", transcoder.apply, src, acodec, cand.duration, job.path("audio"))
+            if res != src:
+                self.cleanup(src)
+            if res != "TOO_BIG" and os.path.getsize(res) > MAX_FILE_SIZE:
+                self.cleanup(res)
+                return "TOO_BIG"
+            return res
+        except Exception as e:
+            record_failure("download", current_source.get(), e)
+            return None
+
+    def _download_ydl_sync(self, cand: Candidate, job: Job) -> tuple:
+        info = dict(cand.info)
+        kind = info.pop('__ydl_kind')
+        opts = dict(self.ydl_opts[kind],
+                    outtmpl=f'{job.path(kind)}.%(ext)s',
+                    progress_hooks=[self._cancel_hook(job)])
+        with yt_dlp.YoutubeDL(opts) as ydl:
+            result = ydl.process_ie_result(ydl.sanitize_info(info), download=True)
+        downloads = (result or {}).get('requested_downloads') or [result or {}]
+        path = downloads[0].get('filepath')
+        if not path or not os.path.exists(path):
+            return None, None
+        return path, downloads[0].get('acodec') or result.get('acodec')
+
+    async def fetch_zaycev(self, cand: Candidate, job: Job) -> Optional[str]:
+        with metrics.timer("stage_seconds", stage="download", source="Zaycev.net"):
+            return await self._fetch_zaycev(cand, job)
+
+    async def _fetch_zaycev(self, cand: Candidate, job: Job) -> Optional[str]:
+        tmp = job.path("zaycev.mp3")
+        try:
+            async with await http.get(cand.url) as ar:
+                ar.raise_for_status()
+                ct = ar.headers.get('content-type','')
+                if 'audio' not in ct:
+                    return None
+                if ar.content_length is not None:
+                    if ar.content_length > MAX_FILE_SIZE:
+                        return "TOO_BIG"
+                    if ar.content_length < 1000:
+                        return None
+                sz = 0
+                # Disk writes go to the download pool so a slow disk does not stall the event loop
+                loop = asyncio.get_running_loop()
+                pool = engine.pools["download"]
+                f = await loop.run_in_executor(pool, open, tmp, 'wb')
+                try:
+                    with buffers.buffer() as buf:
+                        fill = 0
+                        async for chunk in ar.content.iter_any():
+                            sz += len(chunk)
+                            if sz > MAX_FILE_SIZE or job.cancelled.is_set():
+                                break
+                            if fill + len(chunk) > len(buf):
+                                await loop.run_in_executor(pool, f.write, buf[:fill])
+                                fill = 0
+                            if len(chunk) >= len(buf):
+                                await loop.run_in_executor(pool, f.write, chunk)
+                            else:
+                                buf[fill:fill + len(chunk)] = chunk
+                                fill += len(chunk)
+                        await loop.run_in_executor(pool, f.write, buf[:fill])
+                finally:
+                    await loop.run_in_executor(pool, f.close)
+            if job.cancelled.is_set():
+                self.cleanup(tmp)
                 return None
             if sz > MAX_FILE_SIZE:
-                os.remove(tmp)
+                self.cleanup(tmp)
                 return "TOO_BIG"
+            if sz < 1000:
+                self.cleanup(tmp)
+                return None
             return tmp
-        except Exception:
+        except Exception as e:
+            record_failure("download", "Zaycev.net", e)
+            self.cleanup(tmp)
             return None
 
-    async def search_alternative(self, query: str) -> Optional[str]:
-        for q in (f"ytsearch1:{query} site:soundcloud.com",
-                  f"ytsearch1:{query} audio"):
-            output = os.path.join(TEMP_DIR, f"alt_{int(time.time())}")
-            opts = {'format':'bestaudio/best',
-                    'outtmpl':f'{output}.%(ext)s',
-                    'quiet':True,
-                    'postprocessors':[{'key':'FFmpegExtractAudio'}]}
-            try:
-                with yt_dlp.YoutubeDL(opts) as ydl:
-                    info = ydl.extract_info(q, download=False)
-                    if not info or not info.get('entries'):
-                        continue
-                    vid = info['entries'][0]
-                    if vid.get('duration',0) > MAX_DURATION:
-                        continue
-                    ydl.download([vid['webpage_url']])
-                    mp3 = f"{output}.mp3"
-                    if os.path.exists(mp3) and os.path.getsize(mp3) <= MAX_FILE_SIZE:
-                        return mp3
-                    if os.path.exists(mp3):
-                        os.remove(mp3)
-            except:
-                pass
-            await asyncio.sleep(1)
-        return None
+    async def _attempt(self, name: str, resolve, query: str) -> Optional[Candidate]:
+        st = self.source_stats[name]
+        current_source.set(name)
+        started = time.monotonic()
+        cancelled = False
+        try:
+            with tracer.span(f"search {name}", source=name) as span:
+                cand = await resolve(query)
+                if span:
+                    span.set(found=bool(cand), candidate=cand.key if cand else None)
+                return cand
+        except asyncio.CancelledError:
+            # A hedge that lost the race is neither a failed attempt nor a latency sample.
+            # Cancelling does not stop the yt-dlp extract already running in the pool thread
+            cancelled = True
+            st["cancelled"] += 1
+            raise
+        finally:
+            if not cancelled:
+                st["attempts"] += 1
+                elapsed = time.monotonic() - started
+                st["latency"].observe(elapsed)
+                metrics.observe("stage_seconds", elapsed, stage="search", source=name)
 
-    async def download_track(self, query: str, status_cb=None) -> (Optional[str], str):
-        for name, key, func in (
-            ("YouTube", "searching_youtube", self.search_youtube),
-            ("Zaycev.net", "searching_zaycev", self.search_zaycev),
-            ("Alternative", "searching_alternative", self.search_alternative),
-        ):
+    async def _deliver(self, i: int, cand: Candidate, job: Job) -> Optional[str]:
+        name, _, _, fetch = self.sources[i]
+        current_source.set(name)
+        if cand.duration > MAX_DURATION:
+            return "TOO_LONG"
+        if job.flight is not None:
+            other = flights.get(cand.key)
+            # A flight that is itself waiting on another one is never joined: otherwise two
+            # flights falling back onto each other's candidates would wait on each other forever
+            if other is not None and other is not job.flight and other.waiting is None:
+                job.flight.waiting = other
+                try:
+                    res, _, shared = await job.flight.stack.enter_async_context(flights.join(cand.key))
+                finally:
+                    job.flight.waiting = None
+                job.adopt(shared)
+                return res
+            flights.alias(job.flight, cand.key)
+        if self._known(job, cand.key):
+            res = "CACHED"
+        else:
+            job.track_id = cand.key
+            with tracer.span(f"fetch {name}", source=name, candidate=cand.key) as span:
+                res = await fetch(cand, job)
+                if span:
+                    span.set(result=res if res in ("TOO_LONG", "TOO_BIG") else ("ok" if res else "none"))
+        if res and res not in ("TOO_LONG", "TOO_BIG"):
+            self.source_stats[name]["wins"] += 1
+        return res
+
+    async def download_track(self, query: str, status_cb, job: Job) -> (Optional[str], str):
+        skip = None
+        if RACE_MODE:
+            if status_cb:
+                await status_cb("searching_race", query)
+            won = await self._race(query)
+            if won:
+                i, cand = won
+                res = await self._deliver(i, cand, job)
+                if res:
+                    return res, self.sources[i][0]
+                skip = i
+        for i, (name, key, resolve, _) in enumerate(self.sources):
+            if i == skip:
+                continue
             if status_cb:
                 await status_cb(key, query)
-            res = await func(query)
-            if res == "TOO_LONG":
-                return res, name
-            if res == "TOO_BIG":
-                return res, name
+            cand = await self._attempt(name, resolve, query)
+            if not cand:
+                continue
+            res = await self._deliver(i, cand, job)
             if res:
                 return res, name
         return None, "nowhere"
 
+    async def _race(self, query: str) -> Optional[tuple]:
+        async def hedged(i, name, resolve):
+            await asyncio.sleep(i * HEDGE_DELAY)
+            return await self._attempt(name, resolve, query)
+
+        tasks = {
+            asyncio.ensure_future(hedged(i, name, resolve)): i
+            for i, (name, _, resolve, _) in enumerate(self.sources)
+        }
+        pending = set(tasks)
+        winner, rejected = None, None
+        try:
+            while pending and winner is None:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for t in sorted(done, key=tasks.get):
+                    cand = None if t.exception() else t.result()
+                    if not cand:
+                        continue
+                    if cand.duration > MAX_DURATION:
+                        if rejected is None or tasks[t] < rejected[0]:
+                            rejected = (tasks[t], cand)
+                    elif winner is None:
+                        winner = (tasks[t], cand)
+        finally:
+            for t in pending:
+                t.cancel()
+        return winner or rejected
+
+    def stats(self) -> dict:
+        out = {}
+        for name, st in self.source_stats.items():
+            h = st["latency"]
+            out[name] = {
+                "attempts": st["attempts"],
+                "wins": st["wins"],
+                "cancelled": st["cancelled"],
+                "win_rate": st["wins"] / st["attempts"] if st["attempts"] else 0.0,
+                "p50": h.quantile(0.5),
+                "p95": h.quantile(0.95),
+            }
+        return out
+
     def cleanup(self, path: str):
         try:
             if path and os.path.exists(path):
@@ -214,9 +1944,23 @@ downloader = MultiSourceDownloader()
 def main_menu():
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="🔍 Поиск музыки", callback_data="search")],
+        [InlineKeyboardButton(text="🎯 Поиск с выбором", callback_data="find")],
         [InlineKeyboardButton(text="ℹ️ Помощь", callback_data="help")]
     ])
 
+def fmt_duration(seconds: int) -> str:
+    return f"{seconds // 60}:{seconds % 60:02d}" if seconds else "?:??"
+
+def pick_menu(token: str, entries: tuple):
+    rows = [[InlineKeyboardButton(text=f"{title[:48]} · {fmt_duration(duration)}",
+                                  callback_data=f"pick:{token}:{i}")]
+            for i, (_, title, duration) in enumerate(entries)]
+    rows.append([InlineKeyboardButton(text="❌ Отмена", callback_data=f"pick:{token}:x")])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+# chat_id -> (token, ((video_id, title, duration), ...)); the token ties a keyboard to its results
+picks = TTLCache(PICKER_TTL, PICKER_CHATS)
+
 def back_menu():
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="🏠 Главное меню", callback_data="start")]
@@ -230,6 +1974,50 @@ async def cmd_start(m: Message):
 async def cmd_help(m: Message):
     await m.answer(TEXTS["help"], reply_markup=back_menu())
 
+@dp.message(Command("find"))
+async def cmd_find(m: Message, state: FSMContext):
+    query = (m.text or "").partition(" ")[2].strip()
+    if not query:
+        await m.answer(TEXTS["search_prompt"])
+        await state.set_state(MusicStates.waiting_pick)
+        return
+    await process_find(m, query)
+
+@dp.message(Command("stats"))
+async def cmd_stats(m: Message):
+    if m.from_user.id not in ADMIN_IDS:
+        return
+    sf = flights.stats()
+    sc = scheduler.stats()
+    lines = [f"Загрузки: {sc['active']}/{sc['max_active']} активно, в очереди {sc['queued']} "
+             f"из {sc['chats']} чатов, отклонено {sc['shed']}",
+             f"Совмещённые запросы: в работе {sf['inflight']}, запущено {sf['started']}, "
+             f"присоединились {sf['joined']}", "Пулы исполнения:"]
+    for stage, c in engine.stats().items():
+        lines.append(f"{stage}: {c['active']}/{c['workers']} активно, "
+                     f"в очереди {c['queued']}, готово {c['done']}, ошибок {c['failed']}")
+    for name, st in downloader.stats().items():
+        lines.append(f"{name}: попыток {st['attempts']}, побед {st['wins']} ({st['win_rate']:.0%}), отменено {st['cancelled']}, "
+                     f"p50 ≤{st['p50']}с, p95 ≤{st['p95']}с")
+    rc = downloader.resolved.stats()
+    lines.append(f"Кэш поиска: {rc['size']} записей, попаданий {rc['hits']}, промахов {rc['misses']}")
+    for label, cache in (("Zaycev поиск", downloader.zaycev_search), ("Zaycev треки", downloader.zaycev_tracks)):
+        zc = cache.stats()
+        lines.append(f"{label}: {zc['size']} записей, попаданий {zc['hits']}, промахов {zc['misses']}")
+    ws = workspace.stats()
+    lines.append(f"Диск: {ws['usage'] // 1048576}/{ws['quota'] // 1048576} MB, задач {ws['jobs']}, "
+                 f"ждут места {ws['waiting']}, освобождено {ws['reclaimed'] // 1048576} MB")
+    for choice, t in transcoder.stats().items():
+        lines.append(f"Аудио {choice}: {t['count']} раз, {t['cpu']} CPU-с")
+    if jobs:
+        jq = await jobs.stats()
+        lines.append(f"Общая очередь: {jq['queued']} ждут, воркеров {jq['workers']}, отправлено {jq['submitted']}, "
+                     f"выполнено {jq['done']}, ошибок {jq['failed']}, возвращено {jq['requeued']}")
+    fc = file_cache.stats()
+    lines.append(f"Кэш file_id: {fc['size']} записей, попаданий {fc['hits']}, "
+                 f"промахов {fc['misses']}, устарело {fc['invalidated']}")
+    await m.answer("\n".join(lines))
+
 @dp.callback_query(F.data=="start")
 async def cb_start(q: CallbackQuery):
     await q.message.edit_text(TEXTS["welcome"], reply_markup=main_menu())
@@ -243,50 +2031,585 @@ async def cb_search(q: CallbackQuery, state: FSMContext):
     await q.message.edit_text(TEXTS["search_prompt"])
     await state.set_state(MusicStates.waiting_search)
 
+@dp.callback_query(F.data=="find")
+async def cb_find(q: CallbackQuery, state: FSMContext):
+    await q.message.edit_text(TEXTS["search_prompt"])
+    await state.set_state(MusicStates.waiting_pick)
+
+@dp.callback_query(F.data.startswith("pick:"))
+async def cb_pick(q: CallbackQuery):
+    _, token, choice = q.data.split(":")
+    entry = picks.get(q.message.chat.id)
+    if not entry or entry[0] != token:
+        await q.answer(TEXTS["pick_expired"], show_alert=True)
+        return
+    await q.answer()
+    if choice == "x":
+        await q.message.edit_text(TEXTS["pick_cancelled"], reply_markup=main_menu())
+        return
+    video_id, title, _ = entry[1][int(choice)]
+    with request_span("pick request", q.message.chat.id, q.from_user.id, video_id=video_id):
+        await process_pick(q.message, q.from_user.id, video_id, title)
+
+# Bot API errors that mean the file_id itself is unusable; anything else (blocked bot, missing
+# chat, bad caption) says nothing about the cache entry
+STALE_FILE_RE = re.compile(r"file identifier|file_id|file reference|FILE_REFERENCE|MEDIA_EMPTY|"
+                           r"wrong type of the web page content|failed to get HTTP URL content", re.I)
+
+async def send_cached(m: Message, file_id: str, caption: str) -> bool:
+    try:
+        await m.answer_audio(file_id, caption=caption)
+        return True
+    except TelegramBadRequest as e:
+        if not STALE_FILE_RE.search(e.message):
+            raise
+        logger.warning(f"Stale file_id {file_id}: {e}")
+        file_cache.invalidate(file_id)
+        return False
+
+async def run_flight(flight: Flight, notify, query: str, pick: Optional[str] = None) -> tuple:
+    workdir = await flight.stack.enter_async_context(workspace.job())
+    job = Job(query, workdir)
+    job.flight = job.owner = flight
+    try:
+        if pick:
+            res, src = await downloader.download_picked(pick, job)
+        else:
+            res, src = await downloader.download_track(query, notify, job)
+    except asyncio.CancelledError:
+        job.cancelled.set()
+        raise
+    return res, src, job
+
+async def deliver(m: Message, query: str, query_key: str, status: Message, pick: Optional[str] = None) -> bool:
+    async def upd(key, txt):
+        await status.edit_text(TEXTS[key].format(txt))
+    stale = False
+    factory = lambda flight, notify: run_flight(flight, notify, query, pick)
+    async with flights.join(query_key, factory, upd) as (res, src, job):
+        caption = f"{query}\nНайдено на: {src}"
+        if res == "TOO_LONG":
+            metrics.inc("requests_total", outcome="too_long", source=src)
+            await status.edit_text(TEXTS["too_long_track"])
+            return False
+        if res == "TOO_BIG":
+            metrics.inc("requests_total", outcome="too_big", source=src)
+            await status.edit_text(TEXTS["too_big_file"])
+            return False
+        if not res:
+            metrics.inc("requests_total", outcome="not_found", source="")
+            await status.edit_text(TEXTS["not_found_anywhere"].format(query))
+            return False
+        if res == "CACHED":
+            if await send_cached(m, job.file_id, caption):
+                metrics.inc("requests_total", outcome="cached", source=src)
+                file_cache.put(job.file_id, src, query_key)
+            else:
+                flights.forget(job.flight)
+                stale = True
+        else:
+            owner = job.owner
+            async with owner.upload_lock:
+                if not (owner.file_id and await send_cached(m, owner.file_id, caption)):
+                    await status.edit_text(TEXTS["sending"].format(query))
+                    started = time.monotonic()
+                    with tracer.span("telegram upload", kind="client", source=src,
+                                     streamed=isinstance(res, AudioStream)):
+                        if isinstance(res, AudioStream):
+                            upload = res.input_file()
+                            try:
+                                sent = await m.answer_audio(upload, caption=caption, duration=res.cand.duration,
+                                                            title=res.cand.title or None)
+                            except Exception as e:
+                                if upload.too_big:
+                                    metrics.inc("requests_total", outcome="too_big", source=src)
+                                    await status.edit_text(TEXTS["too_big_file"])
+                                    return False
+                                # Expired URL, ffmpeg failure, Telegram error: download to disk instead
+                                record_failure("upload", src, e)
+                                res = await downloader.fetch_ydl(res.cand, job, stream=False)
+                                if res == "TOO_BIG":
+                                    metrics.inc("requests_total", outcome="too_big", source=src)
+                                    await status.edit_text(TEXTS["too_big_file"])
+                                    return False
+                                if not res:
+                                    metrics.inc("requests_total", outcome="error", source=src)
+                                    await status.edit_text(TEXTS["error"])
+                                    return False
+                                sent = await m.answer_audio(FSInputFile(res), caption=caption)
+                        elif BOT_API_LOCAL:
+                            sent = await m.answer_audio(Path(res).resolve().as_uri(), caption=caption)
+                        else:
+                            sent = await m.answer_audio(FSInputFile(res), caption=caption)
+                    metrics.observe("stage_seconds", time.monotonic() - started, stage="upload", source=src)
+                    media = sent.audio or sent.document
+                    if media:
+                        owner.file_id = media.file_id
+                        file_cache.put(media.file_id, src, job.track_id)
+                if owner.file_id:
+                    file_cache.put(owner.file_id, src, query_key)
+                metrics.inc("requests_total", outcome="found", source=src)
+    if stale:
+        return await deliver(m, query, query_key, status, pick)
+    return True
+
+@contextlib.contextmanager
+def request_span(name: str, chat_id: int, user_id: int, **attributes):
+    current_request.set(os.urandom(16).hex())
+    with tracer.span(name, root=True, kind="server", chat_id=chat_id, user_id=user_id, **attributes) as span:
+        yield span
+
 async def process_search(m: Message, query: str, is_state: bool):
+    with request_span("search request", m.chat.id, m.from_user.id, query=query) as span:
+        handed_off = await _process_search(m, query, is_state)
+        if span:
+            span.set(handed_off=bool(handed_off))
+        return handed_off
+
+async def check_query(m: Message, query: str) -> bool:
     if len(query) < 2:
         await m.answer(TEXTS["too_short"])
-        return
+        return False
     if len(query) > 100:
         await m.answer(TEXTS["too_long"])
+        return False
+    return True
+
+async def _process_search(m: Message, query: str, is_state: bool):
+    if not await check_query(m, query):
         return
-    status = await m.answer("🔍 Начинаю поиск...")
-    async def upd(key, txt):
-        await status.edit_text(TEXTS[key].format(txt))
-    res, src = await downloader.download_track(query, upd)
-    if res == "TOO_LONG":
-        await status.edit_text(TEXTS["too_long_track"])
-    elif res == "TOO_BIG":
-        await status.edit_text(TEXTS["too_big_file"])
-    elif res:
-        await status.edit_text(TEXTS["sending"].format(query))
-        with open(res, "rb") as f:
-            await m.answer_audio(f, caption=f"{query}\nНайдено на: {src}")
-        downloader.cleanup(res)
-        try:
-            await status.delete()
-        except:
-            pass
+    query_key = "q:" + normalize_query(query)
+    cached = file_cache.get(query_key)
+    if cached and await send_cached(m, cached[0], f"{query}\nНайдено на: {cached[1]}"):
+        metrics.inc("requests_total", outcome="cached", source=cached[1])
         if not is_state:
             await m.answer("Готово!", reply_markup=main_menu())
-    else:
+        return
+    status = await m.answer("🔍 Начинаю поиск...")
+    return await dispatch(m, status, m.from_user.id, query, query_key, is_state)
+
+async def process_find(m: Message, query: str):
+    if not await check_query(m, query):
+        return
+    status = await m.answer(TEXTS["pick_search"].format(query))
+    with request_span("find request", m.chat.id, m.from_user.id, query=query):
+        try:
+            entries = await downloader.search(query, PICKER_RESULTS)
+        except Exception as e:
+            record_failure("search", "YouTube picker", e)
+            entries = ()
+    entries = tuple(e for e in entries if e[2] <= MAX_DURATION)
+    if not entries:
+        metrics.inc("requests_total", outcome="not_found", source="")
         await status.edit_text(TEXTS["not_found_anywhere"].format(query))
+        return
+    token = os.urandom(3).hex()
+    picks.put(m.chat.id, (token, entries))
+    await status.edit_text(TEXTS["pick_prompt"].format(query), reply_markup=pick_menu(token, entries))
+
+async def process_pick(m: Message, user_id: int, video_id: str, title: str):
+    track_key = f"youtube:{video_id}"
+    cached = file_cache.get(track_key)
+    if cached and await send_cached(m, cached[0], f"{title}\nНайдено на: {cached[1]}"):
+        metrics.inc("requests_total", outcome="cached", source=cached[1])
+        return
+    status = await m.answer(TEXTS["downloading"].format(title))
+    await dispatch(m, status, user_id, title, track_key, True, video_id)
+
+async def dispatch(m: Message, status: Message, user_id: int, query: str, query_key: str,
+                   is_state: bool, pick: Optional[str] = None):
+    async def on_position(pos):
+        await status.edit_text(TEXTS["queued"].format(pos))
+    try:
+        if jobs:
+            await jobs.submit(m, status, user_id, query, query_key, is_state, on_position, pick)
+            return True
+        if flights.get(query_key):
+            sent = await deliver(m, query, query_key, status, pick)
+        else:
+            async with scheduler.slot(m.chat.id, user_id, on_position):
+                sent = await deliver(m, query, query_key, status, pick)
+    except SchedulerFull as e:
+        metrics.inc("requests_total", outcome=e.reason, source="")
+        await status.edit_text(TEXTS[e.reason])
+        return
+    except Exception as e:
+        metrics.inc("requests_total", outcome="error", source="")
+        record_failure("request", "", e)
+        raise
+    if sent:
+        await finish(m, status, is_state)
+
+async def finish(m: Message, status: Message, is_state: bool):
+    try:
+        await status.delete()
+    except:
+        pass
+    if not is_state:
+        await m.answer("Готово!", reply_markup=main_menu())
 
 @dp.message(MusicStates.waiting_search)
 async def st_search(m: Message, state: FSMContext):
     q = m.text.strip()
-    await process_search(m, q, True)
+    handed_off = await process_search(m, q, True)
     await state.clear()
+    if handed_off:
+        return
     await asyncio.sleep(1)
     await m.answer(TEXTS["welcome"], reply_markup=main_menu())
 
+@dp.message(MusicStates.waiting_pick)
+async def st_pick(m: Message, state: FSMContext):
+    await state.clear()
+    await process_find(m, m.text.strip())
+
 @dp.message(F.text & ~F.text.startswith("/"))
 async def direct(m: Message):
-    await process_search(m, m.text, False)
+    if PICKER_DEFAULT:
+        await process_find(m, m.text.strip())
+    else:
+        await process_search(m, m.text, False)
+
+class JobQueue:
+    """Download jobs shared through Redis: dispatchers push, workers pop and deliver."""
+
+    def __init__(self, redis, prefix: str, max_queued: int, per_user: int, inflight_ttl: int):
+        self.redis = redis
+        self.prefix = prefix
+        self.max_queued = max_queued
+        self.per_user = per_user
+        self.inflight_ttl = inflight_ttl
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self.jobs = f"{prefix}:jobs"
+        self.workers = f"{prefix}:workers"
+        self.results = f"{prefix}:results"
+        self.processing = self.processing_key(self.worker_id)
+        self.submitted = 0
+        self.done = 0
+        self.failed = 0
+        self.requeued = 0
+        self.running = False
+
+    def processing_key(self, worker_id: str) -> str:
+        return f"{self.prefix}:processing:{worker_id}"
+
+    def inflight_key(self, user: str) -> str:
+        return f"{self.prefix}:inflight:{user}"
+
+    async def release(self, user: str):
+        # Counters expire on their own, so a job lost with its worker blocks the user
+        # for inflight_ttl at most; an expired counter must not go negative either
+        key = self.inflight_key(user)
+        if await self.redis.decr(key) <= 0:
+            await self.redis.delete(key)
+
+    async def submit(self, m: Message, status: Message, user_id: int, query: str, query_key: str,
+                     is_state: bool, on_position=None, pick: Optional[str] = None):
+        queued = await self.redis.llen(self.jobs)
+        if queued >= self.max_queued:
+            raise SchedulerFull("queue_full")
+        user = str(user_id)
+        key = self.inflight_key(user)
+        running = await self.redis.incr(key)
+        await self.redis.expire(key, self.inflight_ttl)
+        if running > self.per_user:
+            await self.release(user)
+            raise SchedulerFull("user_busy")
+        if queued and on_position:
+            await on_position(queued + 1)
+        span = current_span.get()
+        await self.redis.lpush(self.jobs, json.dumps({
+            "query": query,
+            "query_key": query_key,
+            "pick": pick,
+            "is_state": is_state,
+            "user": user,
+            "enqueued": time.time(),
+            "request_id": current_request.get(),
+            "traceparent": span.traceparent() if span else None,
+            "message": m.model_dump(mode="json", exclude_none=True),
+            "status": status.model_dump(mode="json", exclude_none=True),
+        }))
+        self.submitted += 1
+
+    async def handle(self, job: dict):
+        m = Message.model_validate(job["message"], context={"bot": bot})
+        status = Message.model_validate(job["status"], context={"bot": bot})
+        query, query_key = job["query"], job["query_key"]
+        metrics.observe("queue_wait_seconds", max(0.0, time.time() - job.get("enqueued", time.time())), queue="redis")
+        cached = file_cache.get(query_key)
+        if cached and await send_cached(m, cached[0], f"{query}\nНайдено на: {cached[1]}"):
+            metrics.inc("requests_total", outcome="cached", source=cached[1])
+            sent = True
+        else:
+            sent = await deliver(m, query, query_key, status, job.get("pick"))
+        if sent:
+            await finish(m, status, job["is_state"])
+        if job["is_state"] and not job.get("pick"):
+            await asyncio.sleep(1)
+            await m.answer(TEXTS["welcome"], reply_markup=main_menu())
+        cached = file_cache.get(query_key) if sent else None
+        if cached:
+            await self.redis.publish(self.results, json.dumps(
+                {"query_key": query_key, "file_id": cached[0], "source": cached[1]}))
+
+    async def consume(self):
+        while self.running:
+            raw = await self.redis.blmove(self.jobs, self.processing, WORKER_HEARTBEAT, "RIGHT", "LEFT")
+            if raw is None:
+                continue
+            job = json.loads(raw)
+            current_request.set(job.get("request_id") or os.urandom(16).hex())
+            try:
+                with tracer.span("download job", root=True, traceparent=job.get("traceparent"),
+                                 kind="consumer", query=job["query"], worker=self.worker_id):
+                    await self.handle(job)
+                self.done += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.failed += 1
+                metrics.inc("requests_total", outcome="error", source="")
+                record_failure("job", "", e)
+            await self.release(job["user"])
+            await self.redis.lrem(self.processing, 1, raw)
+
+    async def heartbeat(self):
+        while True:
+            await self.redis.zadd(self.workers, {self.worker_id: time.time()})
+            await self.requeue_dead()
+            await asyncio.sleep(WORKER_HEARTBEAT)
+
+    async def requeue(self, worker_id: str):
+        # RIGHT end of the jobs list is popped next, so requeued jobs keep their turn
+        while await self.redis.lmove(self.processing_key(worker_id), self.jobs, "RIGHT", "RIGHT"):
+            self.requeued += 1
+            logger.warning(f"Requeued a job left by worker {worker_id}")
+
+    async def requeue_dead(self):
+        deadline = time.time() - 3 * WORKER_HEARTBEAT
+        for dead in await self.redis.zrangebyscore(self.workers, 0, deadline):
+            dead = dead.decode() if isinstance(dead, bytes) else dead
+            await self.requeue(dead)
+            await self.redis.zrem(self.workers, dead)
+
+    async def work(self, concurrency: int):
+        # A restarted container often gets the same hostname and pid as its predecessor
+        await self.requeue(self.worker_id)
+        self.running = True
+        tasks = [asyncio.create_task(self.heartbeat())]
+        tasks += [asyncio.create_task(self.consume()) for _ in range(concurrency)]
+        logger.info(f"Worker {self.worker_id} consuming {self.jobs} with {concurrency} slots")
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            self.running = False
+            for t in tasks:
+                t.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            # Interrupted jobs go back to the queue before the worker entry disappears,
+            # otherwise requeue_dead would never find them
+            await self.requeue(self.worker_id)
+            await self.redis.zrem(self.workers, self.worker_id)
+
+    async def listen(self):
+        pubsub = self.redis.pubsub()
+        await pubsub.subscribe(self.results)
+        try:
+            async for msg in pubsub.listen():
+                if msg["type"] != "message":
+                    continue
+                res = json.loads(msg["data"])
+                file_cache.put(res["file_id"], res["source"], res["query_key"])
+        finally:
+            await pubsub.aclose()
+
+    async def stats(self) -> dict:
+        return {"queued": await self.redis.llen(self.jobs), "workers": await self.redis.zcard(self.workers),
+                "submitted": self.submitted, "done": self.done, "failed": self.failed, "requeued": self.requeued}
+
+jobs = JobQueue(redis_client, REDIS_PREFIX, MAX_QUEUED_JOBS, PER_USER_JOBS,
+               JOB_INFLIGHT_TTL) if JOB_QUEUE == "redis" else None
+
+class WebServer:
+    def __init__(self):
+        self.queue = None
+        self.workers = []
+        self.runners = []
+        self.ready = False
+        self.received = 0
+        self.rejected = 0
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get("/healthz", self.health)
+        app.router.add_get("/readyz", self.readiness)
+        if not METRICS_PORT:
+            app.router.add_get("/metrics", self.metrics)
+        if WEBHOOK_URL:
+            app.router.add_post(WEBHOOK_PATH, self.webhook)
+        return app
+
+    def metrics_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get("/metrics", self.metrics)
+        return app
+
+    async def health(self, request: web.Request) -> web.Response:
+        return web.json_response({"status": "ok"})
+
+    async def readiness(self, request: web.Request) -> web.Response:
+        sc = scheduler.stats()
+        ready = self.ready and sc["queued"] < MAX_QUEUED_JOBS
+        body = {"ready": ready, "active": sc["active"], "queued": sc["queued"],
+                "updates_queued": self.queue.qsize() if self.queue else 0}
+        return web.json_response(body, status=200 if ready else 503)
+
+    async def metrics(self, request: web.Request) -> web.Response:
+        return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8",
+                            headers={"X-Prometheus-Format": "0.0.4"})
+
+    async def webhook(self, request: web.Request) -> web.Response:
+        if not hmac.compare_digest(
+                request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), WEBHOOK_SECRET):
+            return web.Response(status=401)
+        try:
+            update = types.Update.model_validate(await request.json(), context={"bot": bot})
+        except Exception:
+            return web.Response(status=400)
+        try:
+            self.queue.put_nowait(update)
+        except asyncio.QueueFull:
+            self.rejected += 1
+            return web.Response(status=503)
+        self.received += 1
+        return web.Response()
+
+    async def worker(self):
+        while True:
+            update = await self.queue.get()
+            try:
+                await dp.feed_update(bot, update)
+            except Exception as e:
+                logger.error(f"Update {update.update_id} failed: {e}")
+            finally:
+                self.queue.task_done()
+
+    async def start(self):
+        self.queue = asyncio.Queue(WEBHOOK_QUEUE)
+        if WEBHOOK_URL:
+            self.workers = [asyncio.create_task(self.worker()) for _ in range(WEBHOOK_WORKERS)]
+        if SERVER_PORT:
+            await self._listen(self.app(), SERVER_HOST, SERVER_PORT)
+            logger.info(f"HTTP server on {SERVER_HOST}:{SERVER_PORT}")
+        if METRICS_PORT:
+            try:
+                await self._listen(self.metrics_app(), METRICS_HOST, METRICS_PORT)
+                logger.info(f"Metrics on {METRICS_HOST}:{METRICS_PORT}")
+            except OSError as e:
+                # Another process on this host already has the port; metrics are not worth failing for
+                logger.error(f"Metrics listener on {METRICS_HOST}:{METRICS_PORT} failed: {e}")
+
+    async def _listen(self, app: web.Application, host: str, port: int):
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        self.runners.append(runner)
+        await web.TCPSite(runner, host, port).start()
+
+    async def stop(self):
+        self.ready = False
+        for w in self.workers:
+            w.cancel()
+        for runner in self.runners:
+            await runner.cleanup()
+
+server = WebServer()
+
+@metrics.collect
+def runtime_metrics():
+    caches = {
+        "resolve": downloader.resolved.stats(),
+        "zaycev_search": downloader.zaycev_search.stats(),
+        "zaycev_tracks": downloader.zaycev_tracks.stats(),
+        "file_id": file_cache.stats(),
+    }
+    for name, c in caches.items():
+        yield "cache_hits_total", {"cache": name}, c["hits"]
+        yield "cache_misses_total", {"cache": name}, c["misses"]
+        yield "cache_entries", {"cache": name}, c["size"]
+    sc = scheduler.stats()
+    yield "jobs", {"state": "active"}, sc["active"]
+    yield "jobs", {"state": "queued"}, sc["queued"]
+    yield "jobs", {"state": "coalesced"}, flights.stats()["inflight"]
+    for stage, c in engine.stats().items():
+        yield "pool_threads", {"stage": stage, "state": "active"}, c["active"]
+        yield "pool_threads", {"stage": stage, "state": "queued"}, c["queued"]
+    ws = workspace.stats()
+    yield "workspace_bytes", {"kind": "used"}, ws["usage"]
+    yield "workspace_bytes", {"kind": "committed"}, ws["committed"]
+    yield "workspace_bytes", {"kind": "quota"}, ws["quota"]
+    yield "workspace_reclaimed_bytes_total", {}, ws["reclaimed"]
+    yield "workspace_jobs", {"state": "live"}, ws["jobs"]
+    yield "workspace_jobs", {"state": "waiting"}, ws["waiting"]
+
+async def until_stopped():
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        with contextlib.suppress(NotImplementedError):
+            loop.add_signal_handler(sig, stop.set)
+    await stop.wait()
+
+async def run_webhook():
+    await bot.set_webhook(
+        WEBHOOK_URL + WEBHOOK_PATH,
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=dp.resolve_used_update_types(),
+        max_connections=min(100, WEBHOOK_WORKERS),
+        drop_pending_updates=False,
+    )
+    server.ready = True
+    logger.info(f"Webhook set to {WEBHOOK_URL}{WEBHOOK_PATH}")
+    await until_stopped()
 
-async def main():
+async def main(mode: str = RUN_MODE):
+    if mode not in ("all", "bot", "worker"):
+        raise RuntimeError(f"Unknown run mode {mode!r}, expected all, bot or worker")
+    if mode != "all" and not jobs:
+        raise RuntimeError(f"Run mode {mode!r} needs REDIS_URL and JOB_QUEUE=redis")
+    if WEBHOOK_URL and mode != "worker" and not WEBHOOK_SECRET:
+        raise RuntimeError("Webhook mode needs WEBHOOK_SECRET, otherwise anyone can post updates")
     Path(TEMP_DIR).mkdir(exist_ok=True)
-    await dp.start_polling(bot, skip_updates=True)
+    workspace.start(WORKSPACE_ORPHAN_AGE)
+    tasks = [asyncio.create_task(workspace.sweeper(WORKSPACE_SWEEP_INTERVAL, WORKSPACE_ORPHAN_AGE))]
+    if tracer.enabled:
+        tasks.append(asyncio.create_task(tracer.exporter(TRACE_FLUSH_INTERVAL)))
+    if jobs:
+        tasks.append(asyncio.create_task(jobs.listen()))
+        if mode != "bot":
+            tasks.append(asyncio.create_task(jobs.work(WORKER_CONCURRENCY)))
+    await server.start()
+    try:
+        if mode == "worker":
+            server.ready = True
+            await until_stopped()
+        elif WEBHOOK_URL:
+            await run_webhook()
+        else:
+            await bot.delete_webhook()
+            server.ready = True
+            await dp.start_polling(bot, skip_updates=True)
+    finally:
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await server.stop()
+        await http.close()
+        await dp.storage.close()
+        if redis_client is not None:
+            await redis_client.aclose()
+        await bot.session.close()
+        engine.shutdown()
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    asyncio.run(main(sys.argv[1] if len(sys.argv) > 1 else RUN_MODE))
@@ -1,14 +1,23 @@
 # Сохранем основной код бота в отдельный файл
 bot_code = '''import os
+import sys
+import json
+import time
+import uuid
 import tempfile
 import asyncio
 import logging
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import List, Dict, Optional
 
 from aiogram import Bot, Dispatcher, types, F
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.filters import Command
-from aiogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
+from aiogram.types import (Message, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery,
+                           FSInputFile, InputMediaAudio)
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.storage.memory import MemoryStorage
@@ -31,9 +40,35 @@ YANDEX_TOKEN = os.getenv("YANDEX_TOKEN", "")
 MAX_FILE_SIZE = 50 * 1024 * 1024  # 50MB Telegram limit
 MAX_DURATION = 600  # 10 minutes max duration
 TEMP_DIR = tempfile.gettempdir()
+REDIS_URL = os.getenv("REDIS_URL", "")  # общее хранилище состояний для нескольких процессов
+FSM_TTL = int(os.getenv("FSM_TTL", "86400"))
+YTDL_WORKERS = int(os.getenv("YTDL_WORKERS", "4"))  # параллельные загрузки yt-dlp
+RESOLVE_WORKERS = int(os.getenv("RESOLVE_WORKERS", "4"))  # параллельные поиски на YouTube
+VIDEO_CACHE_TTL = int(os.getenv("VIDEO_CACHE_TTL", "3600"))  # кэш найденных видео (сек)
+VIDEO_CACHE_SIZE = int(os.getenv("VIDEO_CACHE_SIZE", "2000"))
+PLAYLIST_CONCURRENCY = int(os.getenv("PLAYLIST_CONCURRENCY", "3"))  # треков плейлиста качается одновременно
+PLAYLIST_MAX_TRACKS = int(os.getenv("PLAYLIST_MAX_TRACKS", "100"))
+MEDIA_GROUP_SIZE = 10  # лимит Telegram на альбом
+SERVICE_WORKERS = int(os.getenv("SERVICE_WORKERS", "4"))  # потоки для запросов к ВК и Яндексу
+PLAYLIST_TTL = int(os.getenv("PLAYLIST_TTL", "600"))  # кэш плейлистов (сек)
+PLAYLIST_CACHE_SIZE = int(os.getenv("PLAYLIST_CACHE_SIZE", "200"))
+YANDEX_BATCH = 100  # треков в одном запросе /tracks
+VK_CHUNK = 50  # треков ВК в одном audio.get
+VK_EXECUTE_CALLS = 25  # лимит вызовов внутри одного execute
+TRACKS_MAX_MB = int(os.getenv("TRACKS_MAX_MB", "64"))  # память под списки треков плейлистов
+TRACKS_IDLE = int(os.getenv("TRACKS_IDLE", "1800"))  # выгружать плейлист, если его не листали N сек
+KEYBOARD_CACHE = int(os.getenv("KEYBOARD_CACHE", "1000"))  # готовых страниц клавиатур в памяти
+PAGE_SIZE = 5
+
+def make_storage():
+    if not REDIS_URL:
+        return MemoryStorage()
+    from aiogram.fsm.storage.redis import RedisStorage, DefaultKeyBuilder
+    return RedisStorage.from_url(REDIS_URL, key_builder=DefaultKeyBuilder(prefix="music:fsm"),
+                                 state_ttl=FSM_TTL, data_ttl=FSM_TTL)
 
 bot = Bot(token=BOT_TOKEN)
-storage = MemoryStorage()
+storage = make_storage()
 dp = Dispatcher(storage=storage)
 
 class MusicStates(StatesGroup):
@@ -43,13 +78,148 @@ class MusicStates(StatesGroup):
     browsing_yandex_tracks = State()
     waiting_search_query = State()
 
+class TTLCache:
+    """LRU cache whose entries expire after `ttl` seconds."""
+
+    def __init__(self, ttl: float, maxsize: int):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.data = OrderedDict()  # key -> (expires, value)
+
+    def get(self, key):
+        entry = self.data.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= time.monotonic():
+            del self.data[key]
+            return None
+        self.data.move_to_end(key)
+        return entry[1]
+
+    def put(self, key, value):
+        self.data[key] = (time.monotonic() + self.ttl, value)
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+class TrackList:
+    """Tracks of one playlist, shared by every user who opens it.
+
+    Titles and durations are kept in flat columns instead of a dict per
+    track; VK playlists grow VK_CHUNK at a time as the user scrolls.
+    """
+    __slots__ = ("handle", "title", "titles", "durations", "total", "nbytes", "created", "last_used", "lock")
+
+    def __init__(self, handle: str, title: str):
+        self.handle = handle
+        self.title = title
+        self.titles = []  # "Artist - Title", doubles as the YouTube query
+        self.durations = array('I')
+        self.total = None  # known after the first page is loaded
+        self.nbytes = sys.getsizeof(self.titles) + sys.getsizeof(self.durations)
+        self.created = self.last_used = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def __len__(self) -> int:
+        return len(self.titles)
+
+    @property
+    def size(self) -> int:
+        return len(self.titles) if self.total is None else self.total
+
+    @property
+    def complete(self) -> bool:
+        return self.total is not None and len(self.titles) >= self.total
+
+    def extend(self, tracks):
+        for title, duration in tracks:
+            self.titles.append(title)
+            self.durations.append(duration)
+            self.nbytes += sys.getsizeof(title) + 8 + self.durations.itemsize
+
+class TrackStore:
+    """Server-side playlists; FSM data keeps only a handle such as "vk:123"."""
+
+    def __init__(self, max_bytes: int, idle: float, ttl: float):
+        self.max_bytes = max_bytes
+        self.idle = idle
+        self.ttl = ttl
+        self.lists: Dict[str, TrackList] = {}
+
+    @property
+    def nbytes(self) -> int:
+        return sum(tracks.nbytes for tracks in self.lists.values())
+
+    def get(self, handle: str) -> Optional[TrackList]:
+        tracks = self.lists.get(handle)
+        if tracks is None:
+            return None
+        now = time.monotonic()
+        if now - tracks.created > self.ttl and not tracks.lock.locked():
+            # Устаревший плейлист загрузим заново
+            del self.lists[handle]
+            return None
+        tracks.last_used = now
+        return tracks
+
+    def add(self, tracks: TrackList) -> TrackList:
+        self.lists[tracks.handle] = tracks
+        self.evict()
+        return tracks
+
+    def evict(self):
+        now = time.monotonic()
+        before = len(self.lists)
+        for handle, tracks in list(self.lists.items()):
+            if now - tracks.last_used > self.idle and not tracks.lock.locked():
+                del self.lists[handle]
+        nbytes = self.nbytes
+        # Сверх лимита памяти вытесняем давно не используемые
+        for tracks in sorted(self.lists.values(), key=lambda t: t.last_used):
+            if nbytes <= self.max_bytes or len(self.lists) == 1:
+                break
+            if not tracks.lock.locked():
+                del self.lists[tracks.handle]
+                nbytes -= tracks.nbytes
+        if len(self.lists) != before:
+            logger.info(f"Track store: {len(self.lists)} playlists, {nbytes // 1024} KB "
+                        f"({before - len(self.lists)} evicted)")
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(60)
+            self.evict()
+
 class TechnicalMusicService:
     def __init__(self):
         self.vk_session = None
         self.vk_audio = None
         self.yandex_client = None
+        # Клиенты ВК и Яндекса синхронные — вызываем их в отдельных потоках
+        self.executor = ThreadPoolExecutor(max_workers=SERVICE_WORKERS, thread_name_prefix="music-api")
+        self.cache = TTLCache(PLAYLIST_TTL, PLAYLIST_CACHE_SIZE)
+        self.loading = {}  # key -> future, so concurrent users share one request
+        self.tracks = TrackStore(TRACKS_MAX_MB * 1024 * 1024, TRACKS_IDLE, PLAYLIST_TTL)
         self.init_services()
 
+    def _loaded(self, key, fut: asyncio.Future):
+        self.loading.pop(key, None)
+        if not fut.cancelled() and fut.exception() is None:
+            self.cache.put(key, fut.result())
+
+    async def cached(self, key, func, *args):
+        """Return a cached result or run the blocking `func` in the executor, once per key."""
+        value = self.cache.get(key)
+        if value is not None:
+            return value
+        fut = self.loading.get(key)
+        if fut is None:
+            loop = asyncio.get_running_loop()
+            fut = asyncio.ensure_future(loop.run_in_executor(self.executor, func, *args))
+            fut.add_done_callback(lambda f: self._loaded(key, f))
+            self.loading[key] = fut
+        return await asyncio.shield(fut)
+
     def init_services(self):
         if VK_ACCESS_TOKEN:
             try:
@@ -71,105 +241,188 @@ class TechnicalMusicService:
         if not self.vk_session:
             return []
         try:
-            vk = self.vk_session.get_api()
-            response = vk.audio.getPlaylists(owner_id=None)
-            playlists = response['items']
-            return [{"id": pl['id'], "title": pl['title']} for pl in playlists]
+            return await self.cached(("vk", "playlists"), self._vk_playlists)
         except Exception as e:
             logger.error(f"VK playlists fetch error: {e}")
             return []
 
-    async def get_vk_playlist_tracks(self, playlist_id: int) -> List[Dict]:
-        if not self.vk_session:
-            return []
-        try:
-            vk = self.vk_session.get_api()
-            response = vk.audio.get(owner_id=None, album_id=playlist_id)
-            tracks = response['items']
-            return [{
-                'title': f"{audio['artist']} - {audio['title']}",
-                'artist': audio['artist'],
-                'track': audio['title'],
-                'duration': audio.get('duration', 0),
-                'source': 'vk'
-            } for audio in tracks]
-        except Exception as e:
-            logger.error(f"VK playlist tracks fetch error: {e}")
-            return []
+    async def playlist_tracks(self, handle: Optional[str], upto: int = VK_CHUNK) -> Optional[TrackList]:
+        """Return the shared track list for `handle`, loaded to at least `upto` tracks when available."""
+        if not handle:
+            return None
+        source, _, playlist_id = handle.partition(":")
+        if source == "vk" and self.vk_session:
+            playlists, loader = await self.get_vk_playlists(), self._vk_load
+        elif source == "ya" and self.yandex_client:
+            playlists, loader = await self.get_yandex_playlists(), self._yandex_load
+        else:
+            return None
+        playlist_id = int(playlist_id)
+        tracks = self.tracks.get(handle)
+        if tracks is None:
+            title = next((pl['title'] for pl in playlists if pl['id'] == playlist_id), "плейлист")
+            tracks = self.tracks.add(TrackList(handle, title))
+        async with tracks.lock:
+            if not tracks.complete and len(tracks) < upto:
+                try:
+                    loop = asyncio.get_running_loop()
+                    await loop.run_in_executor(self.executor, loader, tracks, playlist_id, upto)
+                except Exception as e:
+                    logger.error(f"Playlist tracks fetch error ({handle}): {e}")
+        return tracks
+
+    def _vk_playlists(self) -> List[Dict]:
+        vk = self.vk_session.get_api()
+        response = vk.audio.getPlaylists(owner_id=None)
+        return [{"id": pl['id'], "title": pl['title']} for pl in response['items']]
+
+    def _vk_load(self, tracks: TrackList, album_id: int, upto: int):
+        # Недостающие куски запрашиваем одним execute (до 25 вызовов audio.get за раз)
+        vk = self.vk_session.get_api()
+        offsets = list(range(len(tracks), upto, VK_CHUNK))
+        if tracks.total is not None:
+            offsets = [offset for offset in offsets if offset < tracks.total]
+        for start in range(0, len(offsets), VK_EXECUTE_CALLS):
+            group = offsets[start:start + VK_EXECUTE_CALLS]
+            params = [{"album_id": album_id, "offset": offset, "count": VK_CHUNK} for offset in group]
+            if len(params) == 1:
+                responses = [vk.audio.get(**params[0])]
+            else:
+                calls = ",".join(f"API.audio.get({json.dumps(p)})" for p in params)
+                responses = vk.execute(code=f"return [{calls}];")
+            for response in responses:
+                tracks.total = response['count']
+                tracks.extend((f"{audio['artist']} - {audio['title']}", audio.get('duration', 0))
+                              for audio in response['items'])
+                if not response['items']:
+                    tracks.total = len(tracks)
+            if tracks.complete:
+                break
 
     async def get_yandex_playlists(self) -> List[Dict]:
         if not self.yandex_client:
             return []
         try:
-            playlists = self.yandex_client.users_playlists()
-            return [{"id": pl.kind, "title": pl.title} for pl in playlists]
+            return await self.cached(("yandex", "playlists"), self._yandex_playlists)
         except Exception as e:
             logger.error(f"Yandex playlists fetch error: {e}")
             return []
 
-    async def get_yandex_playlist_tracks(self, playlist_id: str) -> List[Dict]:
-        if not self.yandex_client:
-            return []
-        try:
-            playlists = self.yandex_client.users_playlists()
-            target_playlist = next((pl for pl in playlists if pl.kind == playlist_id), None)
-            if not target_playlist:
-                return []
-            tracks = target_playlist.fetch_tracks()
-            return [{
-                'title': f"{', '.join(tr.artists_name())} - {tr.title}",
-                'artist': ', '.join(tr.artists_name()),
-                'track': tr.title,
-                'duration': tr.duration_ms // 1000 if tr.duration_ms else 0,
-                'source': 'yandex'
-            } for tr in tracks]
-        except Exception as e:
-            logger.error(f"Yandex playlist tracks fetch error: {e}")
-            return []
+    def _yandex_playlists(self) -> List[Dict]:
+        # Только список плейлистов, без треков
+        playlists = self.yandex_client.users_playlists_list()
+        return [{"id": pl.kind, "title": pl.title} for pl in playlists]
+
+    def _yandex_load(self, tracks: TrackList, kind: int, upto: int):
+        # Плейлист Яндекса приходит целиком, upto не нужен
+        playlist = self.yandex_client.users_playlists(kind)
+        shorts = playlist.tracks or []
+        # Обычно треки приходят вместе с плейлистом; недостающие добираем пачками через /tracks
+        loaded = {str(ts.id): ts.track for ts in shorts if ts.track}
+        missing = [ts.track_id for ts in shorts if not ts.track]
+        for start in range(0, len(missing), YANDEX_BATCH):
+            for tr in self.yandex_client.tracks(missing[start:start + YANDEX_BATCH]):
+                loaded[str(tr.id)] = tr
+        tracks.extend((f"{', '.join(tr.artists_name())} - {tr.title}", (tr.duration_ms or 0) // 1000)
+                      for tr in (loaded.get(str(ts.id)) for ts in shorts) if tr)
+        tracks.total = len(tracks)
 
 class MusicDownloader:
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=YTDL_WORKERS, thread_name_prefix="ydl-download")
+        self.resolver = ThreadPoolExecutor(max_workers=RESOLVE_WORKERS, thread_name_prefix="ydl-search")
+        self.resolved = TTLCache(VIDEO_CACHE_TTL, VIDEO_CACHE_SIZE)  # query -> video
+        self.resolving = {}  # query -> future, shared by prefetch and real requests
+
     @staticmethod
-    async def download_track(query: str) -> Optional[str]:
+    def _resolve_sync(query: str) -> Optional[Dict]:
+        opts = {'quiet': True, 'no_warnings': True, 'extract_flat': 'in_playlist'}
+        with yt_dlp.YoutubeDL(opts) as ydl:
+            info = ydl.extract_info(f"ytsearch1:{query}", download=False)
+        if not info or not info.get('entries'):
+            return None
+        video = info['entries'][0]
+        return {
+            'url': video.get('webpage_url') or video['url'],
+            'duration': video.get('duration') or 0,
+        }
+
+    def _store(self, query: str, fut: asyncio.Future):
+        self.resolving.pop(query, None)
+        if fut.cancelled() or fut.exception() or fut.result() is None:
+            return
+        self.resolved.put(query, fut.result())
+
+    def _resolve(self, query: str) -> asyncio.Future:
+        fut = self.resolving.get(query)
+        if fut is None:
+            loop = asyncio.get_running_loop()
+            fut = asyncio.ensure_future(loop.run_in_executor(self.resolver, self._resolve_sync, query))
+            fut.add_done_callback(lambda f: self._store(query, f))
+            self.resolving[query] = fut
+        return fut
+
+    async def resolve(self, query: str) -> Optional[Dict]:
+        video = self.resolved.get(query)
+        if video is not None:
+            return video
+        return await asyncio.shield(self._resolve(query))
+
+    def prefetch(self, queries: List[str]):
+        """Warm the YouTube lookup for tracks the user is likely to open next."""
+        for query in queries:
+            if self.resolved.get(query) is None:
+                self._resolve(query)
+
+    @staticmethod
+    def _download_sync(url: str) -> Optional[str]:
+        output_path = os.path.join(TEMP_DIR, f"temp_{uuid.uuid4().hex}")
+        ydl_opts = {
+            'format': 'bestaudio[ext=m4a]/bestaudio/best',
+            'outtmpl': f'{output_path}.%(ext)s',
+            'quiet': True,
+            'no_warnings': True,
+            'extractaudio': True,
+            'audioformat': 'mp3',
+            'audioquality': '192',
+            'prefer_ffmpeg': True,
+            'keepvideo': False,
+            'postprocessors': [{
+                'key': 'FFmpegExtractAudio',
+                'preferredcodec': 'mp3',
+                'preferredquality': '192',
+            }],
+        }
+        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+            ydl.download([url])
+        mp3_file = f"{output_path}.mp3"
+        if os.path.exists(mp3_file):
+            if os.path.getsize(mp3_file) <= MAX_FILE_SIZE:
+                return mp3_file
+            os.remove(mp3_file)
+        return None
+
+    async def download_track(self, query: str) -> Optional[str]:
         try:
-            output_path = os.path.join(TEMP_DIR, f"temp_{int(asyncio.get_event_loop().time())}")
-            ydl_opts = {
-                'format': 'bestaudio[ext=m4a]/bestaudio/best',
-                'outtmpl': f'{output_path}.%(ext)s',
-                'quiet': True,
-                'no_warnings': True,
-                'extractaudio': True,
-                'audioformat': 'mp3',
-                'audioquality': '192',
-                'prefer_ffmpeg': True,
-                'keepvideo': False,
-                'postprocessors': [{
-                    'key': 'FFmpegExtractAudio',
-                    'preferredcodec': 'mp3',
-                    'preferredquality': '192',
-                }],
-            }
-            search_query = f"ytsearch1:{query}"
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                info = ydl.extract_info(search_query, download=False)
-                if not info.get('entries'):
-                    return None
-                video_info = info['entries'][0]
-                duration = video_info.get('duration', 0)
-                if duration > MAX_DURATION:
-                    return None
-                ydl.download([video_info['webpage_url']])
-                mp3_file = f"{output_path}.mp3"
-                if os.path.exists(mp3_file):
-                    file_size = os.path.getsize(mp3_file)
-                    if file_size <= MAX_FILE_SIZE:
-                        return mp3_file
-                    else:
-                        os.remove(mp3_file)
+            video = await self.resolve(query)
+            if not video or video['duration'] > MAX_DURATION:
                 return None
+            loop = asyncio.get_running_loop()
+            job = loop.run_in_executor(self.executor, self._download_sync, video['url'])
+            try:
+                return await asyncio.shield(job)
+            except asyncio.CancelledError:
+                # Поток yt-dlp не прервать — удаляем файл, когда он докачается
+                job.add_done_callback(self.discard)
+                raise
         except Exception as e:
             logger.error(f"Error downloading {query}: {e}")
             return None
 
+    def discard(self, job: asyncio.Future):
+        if not job.cancelled() and not job.exception() and job.result():
+            self.cleanup_file(job.result())
+
     @staticmethod
     def cleanup_file(file_path: str):
         try:
@@ -182,34 +435,181 @@ music_service = TechnicalMusicService()
 downloader = MusicDownloader()
 
 # --- Keyboards ---
+# Отрисованные страницы общие для всех пользователей: (handle, page, prefix) -> (version, markup)
+keyboards = TTLCache(PLAYLIST_TTL, KEYBOARD_CACHE)
+
+def memo_keyboard(key: tuple, version, build) -> InlineKeyboardMarkup:
+    """Reuse the markup rendered for `key` while its source list is unchanged."""
+    cached = keyboards.get(key)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    markup = build()
+    keyboards.put(key, (version, markup))
+    return markup
+
 def main_menu():
-    keyboard = []
-    keyboard.append([InlineKeyboardButton(text="🔍 Поиск музыки", callback_data="search_music")])
-    if music_service.vk_audio:
-        keyboard.append([InlineKeyboardButton(text="📂 Мои плейлисты ВК", callback_data="vk_playlists")])
-    if music_service.yandex_client:
-        keyboard.append([InlineKeyboardButton(text="📂 Мои плейлисты Яндекс", callback_data="yandex_playlists")])
-    keyboard.append([InlineKeyboardButton(text="ℹ️ Помощь", callback_data="help")])
-    return InlineKeyboardMarkup(inline_keyboard=keyboard)
+    def build():
+        keyboard = []
+        keyboard.append([InlineKeyboardButton(text="🔍 Поиск музыки", callback_data="search_music")])
+        if music_service.vk_audio:
+            keyboard.append([InlineKeyboardButton(text="📂 Мои плейлисты ВК", callback_data="vk_playlists")])
+        if music_service.yandex_client:
+            keyboard.append([InlineKeyboardButton(text="📂 Мои плейлисты Яндекс", callback_data="yandex_playlists")])
+        keyboard.append([InlineKeyboardButton(text="ℹ️ Помощь", callback_data="help")])
+        return InlineKeyboardMarkup(inline_keyboard=keyboard)
+    return memo_keyboard(("menu", 0, "main"), None, build)
 
-def paginated_keyboard(items: List[Dict], prefix: str, page: int = 0, per_page=5):
+def paginated_keyboard(labels: List[str], prefix: str, page: int = 0, per_page=PAGE_SIZE, extra=None,
+                       total: Optional[int] = None):
+    # callback_data: "<prefix>:<индекс>" для элемента и "<prefix>:p<страница>" для навигации —
+    # не зависит от пользователя и страницы, поэтому клавиатуру можно кэшировать
     keyboard = []
     start = page * per_page
-    end = min(start + per_page, len(items))
+    end = min(start + per_page, len(labels))
     for i in range(start, end):
-        item = items[i]
-        key = f"{prefix}_{i}_{page}"
-        keyboard.append([InlineKeyboardButton(text=item['title'][:50], callback_data=key)])
+        keyboard.append([InlineKeyboardButton(text=labels[i][:50], callback_data=f"{prefix}:{i}")])
     nav_buttons = []
     if page > 0:
-        nav_buttons.append(InlineKeyboardButton("⬅️", callback_data=f"{prefix}_page_{page-1}"))
-    if end < len(items):
-        nav_buttons.append(InlineKeyboardButton("➡️", callback_data=f"{prefix}_page_{page+1}"))
+        nav_buttons.append(InlineKeyboardButton(text="⬅️", callback_data=f"{prefix}:p{page-1}"))
+    if end < (len(labels) if total is None else total):
+        nav_buttons.append(InlineKeyboardButton(text="➡️", callback_data=f"{prefix}:p{page+1}"))
     if nav_buttons:
         keyboard.append(nav_buttons)
-    keyboard.append([InlineKeyboardButton("🏠 Главное меню", callback_data="main_menu")])
+    if extra:
+        keyboard.extend(extra)
+    keyboard.append([InlineKeyboardButton(text="🏠 Главное меню", callback_data="main_menu")])
     return InlineKeyboardMarkup(inline_keyboard=keyboard)
 
+def playlists_keyboard(playlists: List[Dict], prefix: str, page: int = 0):
+    return memo_keyboard(("playlists", page, prefix), playlists,
+                         lambda: paginated_keyboard([pl['title'] for pl in playlists], prefix, page))
+
+def tracks_keyboard(tracks: TrackList, page: int = 0):
+    # Пока пользователь смотрит страницу, заранее ищем на YouTube её треки и следующую страницу
+    downloader.prefetch(tracks.titles[page * PAGE_SIZE:(page + 2) * PAGE_SIZE])
+    # Перерисовываем, только если плейлист перезагружен или страница догрузилась
+    version = (tracks.created, tracks.size, min(len(tracks), (page + 1) * PAGE_SIZE))
+    download_all = [[InlineKeyboardButton(text="⬇️ Скачать весь плейлист", callback_data="t:all")]]
+    return memo_keyboard((tracks.handle, page, "t"), version,
+                         lambda: paginated_keyboard(tracks.titles, "t", page, extra=download_all, total=tracks.size))
+
+def tracks_text(tracks: TrackList, hint: str = "Выберите трек для скачивания:") -> str:
+    return f"🎵 **{tracks.title}** ({tracks.size} треков)\\n\\n{hint}"
+
+# Символы разметки Markdown, которых нет в message.text; убираются из обеих строк при сравнении
+MARKDOWN_CHARS = str.maketrans("", "", "*_`[]")
+
+async def show_page(message: Message, text: str, markup: InlineKeyboardMarkup):
+    """edit_text, skipped when the message already shows this text and keyboard."""
+    if (message.reply_markup == markup
+            and (message.text or "").translate(MARKDOWN_CHARS) == text.translate(MARKDOWN_CHARS)):
+        return message
+    try:
+        return await message.edit_text(text, reply_markup=markup, parse_mode="Markdown")
+    except TelegramBadRequest as e:
+        # Сравнение выше может не распознать разметку — тогда Telegram сам скажет, что менять нечего
+        if "message is not modified" not in e.message:
+            raise
+        return message
+
+STOP_KEYBOARD = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="⏹ Остановить", callback_data="playlist_stop")]
+])
+
+# --- Playlist download ---
+playlist_jobs: Dict[int, asyncio.Task] = {}
+
+SOURCES = {"vk": "ВК → YouTube", "ya": "Яндекс → YouTube"}
+
+async def send_batch(message: Message, batch: List[tuple], playlist: str, source: str):
+    captions = [f"🎵 {title}\\n📂 Плейлист: {playlist}\\n📍 Источник: {source}" for _, title in batch]
+    if len(batch) == 1:
+        await message.answer_audio(audio=FSInputFile(batch[0][0]), caption=captions[0])
+    else:
+        await message.answer_media_group([
+            InputMediaAudio(media=FSInputFile(path), caption=caption)
+            for (path, _), caption in zip(batch, captions)
+        ])
+
+async def download_playlist(message: Message, tracklist: TrackList):
+    """Download a playlist through a bounded window and deliver it in playlist order."""
+    playlist = tracklist.title
+    source = SOURCES[tracklist.handle.split(":")[0]]
+    tracks = list(zip(tracklist.titles, tracklist.durations))[:PLAYLIST_MAX_TRACKS]
+    total = len(tracks)
+    status_msg = await message.answer(f"⬇️ **{playlist}**\\n\\n⏳ 0/{total}",
+                                      reply_markup=STOP_KEYBOARD, parse_mode="Markdown")
+    gate = asyncio.Semaphore(PLAYLIST_CONCURRENCY)
+
+    async def fetch(title: str, duration: int) -> Optional[str]:
+        if duration > MAX_DURATION:
+            return None
+        # Поиск идёт без ограничения окна, загрузка — не больше PLAYLIST_CONCURRENCY за раз
+        await downloader.resolve(title)
+        async with gate:
+            return await downloader.download_track(title)
+
+    upcoming = iter(tracks)
+    pending = deque()
+    batch = []
+    sent = failed = shown = 0
+    last_edit = time.monotonic()
+
+    def fill():
+        while len(pending) < PLAYLIST_CONCURRENCY * 2:
+            track = next(upcoming, None)
+            if track is None:
+                return
+            pending.append((track[0], asyncio.ensure_future(fetch(*track))))
+
+    try:
+        fill()
+        while pending:
+            title, task = pending.popleft()
+            fill()
+            try:
+                file_path = await task
+            except Exception as e:
+                logger.error(f"Error downloading {title}: {e}")
+                file_path = None
+            if file_path:
+                batch.append((file_path, title))
+            else:
+                failed += 1
+            if len(batch) == MEDIA_GROUP_SIZE or (batch and not pending):
+                try:
+                    await send_batch(message, batch, playlist, source)
+                    sent += len(batch)
+                except Exception as e:
+                    logger.error(f"Error sending playlist batch: {e}")
+                    failed += len(batch)
+                for path, _ in batch:
+                    downloader.cleanup_file(path)
+                batch = []
+            done = sent + failed + len(batch)
+            if pending and done != shown and time.monotonic() - last_edit > 3:
+                last_edit, shown = time.monotonic(), done
+                try:
+                    await status_msg.edit_text(f"⬇️ **{playlist}**\\n\\n⏳ {done}/{total}",
+                                               reply_markup=STOP_KEYBOARD, parse_mode="Markdown")
+                except Exception:
+                    pass
+        await status_msg.edit_text(f"✅ **{playlist}**\\n\\nОтправлено: {sent}, не найдено: {failed}",
+                                   parse_mode="Markdown")
+    except asyncio.CancelledError:
+        try:
+            await status_msg.edit_text(f"⏹ **{playlist}**\\n\\nОстановлено. Отправлено: {sent}",
+                                       parse_mode="Markdown")
+        except Exception:
+            pass
+        raise
+    finally:
+        for _, task in pending:
+            task.cancel()
+            task.add_done_callback(downloader.discard)
+        for path, _ in batch:
+            downloader.cleanup_file(path)
+
 # --- Handlers ---
 
 @dp.message(Command("start"))
@@ -228,8 +628,7 @@ async def start_cmd(msg: Message):
 
 @dp.callback_query(F.data == "main_menu")
 async def main_menu_handler(query: CallbackQuery):
-    await query.message.edit_text("🎵 **Главное меню**\\n\\nВыберите действие:", 
-                                  reply_markup=main_menu(), parse_mode="Markdown")
+    await show_page(query.message, "🎵 **Главное меню**\\n\\nВыберите действие:", main_menu())
 
 @dp.callback_query(F.data == "search_music")
 async def search_music_handler(query: CallbackQuery, state: FSMContext):
@@ -262,12 +661,11 @@ async def process_search_query(msg: Message, state: FSMContext):
     if file_path:
         await status_msg.edit_text(f"📤 Отправляю: **{query}**", parse_mode="Markdown")
         
-        with open(file_path, "rb") as audio_file:
-            await msg.answer_audio(
-                audio=audio_file,
-                caption=f"🎵 {query}\\n📍 Источник: YouTube",
-                parse_mode="Markdown"
-            )
+        await msg.answer_audio(
+            audio=FSInputFile(file_path),
+            caption=f"🎵 {query}\\n📍 Источник: YouTube",
+            parse_mode="Markdown"
+        )
         downloader.cleanup_file(file_path)
         
         # Удаляем сообщение о статусе
@@ -290,88 +688,43 @@ async def vk_playlists_handler(query: CallbackQuery, state: FSMContext):
     if not music_service.vk_audio:
         await query.answer("❌ ВК сервис не настроен", show_alert=True)
         return
-        
+
     status_msg = await query.message.edit_text("🔄 Загружаю плейлисты ВК...")
-    
+
     playlists = await music_service.get_vk_playlists()
     if not playlists:
         await status_msg.edit_text("❌ Не удалось получить плейлисты ВК")
         return
-        
-    await state.update_data(vk_playlists=playlists)
-    
+
     playlist_text = f"📂 **Ваши плейлисты ВК** ({len(playlists)} шт.)\\n\\nВыберите плейлист:"
-    await status_msg.edit_text(playlist_text, 
-                               reply_markup=paginated_keyboard(playlists, "vkpl"),
+    await status_msg.edit_text(playlist_text,
+                               reply_markup=playlists_keyboard(playlists, "v"),
                                parse_mode="Markdown")
 
-@dp.callback_query(F.data.startswith("vkpl_"))
+@dp.callback_query(F.data.regexp(r"^v:\\d+$"))
 async def vk_playlist_select_handler(query: CallbackQuery, state: FSMContext):
-    data = await state.get_data()
-    playlists = data.get("vk_playlists", [])
-    parts = query.data.split("_")
-    idx = int(parts[1])
-    page = int(parts[2])
-    
+    playlists = await music_service.get_vk_playlists()
+    idx = int(query.data.split(":")[1])
+
     if idx >= len(playlists):
         await query.answer("❌ Плейлист не найден")
         return
-        
+
     playlist = playlists[idx]
-    
-    status_msg = await query.message.edit_text(f"🔄 Загружаю треки из: **{playlist['title']}**", 
+
+    status_msg = await query.message.edit_text(f"🔄 Загружаю треки из: **{playlist['title']}**",
                                                parse_mode="Markdown")
-    
-    tracks = await music_service.get_vk_playlist_tracks(playlist['id'])
+
+    tracks = await music_service.playlist_tracks(f"vk:{playlist['id']}", 2 * PAGE_SIZE)
     if not tracks:
         await status_msg.edit_text("❌ Не удалось получить треки плейлиста")
         return
-        
-    await state.update_data(vk_tracks=tracks, current_playlist=playlist['title'])
-    
-    tracks_text = f"🎵 **{playlist['title']}** ({len(tracks)} треков)\\n\\nВыберите трек для скачивания:"
-    await status_msg.edit_text(tracks_text, 
-                               reply_markup=paginated_keyboard(tracks, "vktr", 0),
-                               parse_mode="Markdown")
 
-@dp.callback_query(F.data.startswith("vktr_"))
-async def vk_track_select_handler(query: CallbackQuery, state: FSMContext):
-    data = await state.get_data()
-    tracks = data.get("vk_tracks", [])
-    current_playlist = data.get("current_playlist", "плейлист")
-    parts = query.data.split("_")
-    idx = int(parts[1])
-    page = int(parts[2])
-    
-    if idx >= len(tracks):
-        await query.answer("❌ Трек не найден")
-        return
-        
-    track = tracks[idx]
-    
-    status_msg = await query.message.edit_text(
-        f"🔄 Скачиваю: **{track['title']}**\\n\\n⏳ Поиск на YouTube...",
-        parse_mode="Markdown"
-    )
-    
-    file_path = await downloader.download_track(track['title'])
-    if file_path:
-        await status_msg.edit_text(f"📤 Отправляю: **{track['title']}**", parse_mode="Markdown")
-        
-        with open(file_path, "rb") as audio_file:
-            await query.message.answer_audio(
-                audio=audio_file,
-                caption=f"🎵 {track['title']}\\n📂 Плейлист: {current_playlist}\\n📍 Источник: ВК → YouTube",
-                parse_mode="Markdown"
-            )
-        downloader.cleanup_file(file_path)
-    else:
-        await query.answer("❌ Не удалось скачать трек", show_alert=True)
-    
-    # Возвращаемся к списку треков
-    tracks_text = f"🎵 **{current_playlist}** ({len(tracks)} треков)\\n\\nВыберите следующий трек:"
-    await status_msg.edit_text(tracks_text, 
-                               reply_markup=paginated_keyboard(tracks, "vktr", page),
+    # Треки лежат в общем хранилище, в состоянии только ссылка на плейлист и номер страницы
+    await state.update_data(tracks=tracks.handle, page=0)
+
+    await status_msg.edit_text(tracks_text(tracks),
+                               reply_markup=tracks_keyboard(tracks, 0),
                                parse_mode="Markdown")
 
 @dp.callback_query(F.data == "yandex_playlists")
@@ -379,119 +732,134 @@ async def yandex_playlists_handler(query: CallbackQuery, state: FSMContext):
     if not music_service.yandex_client:
         await query.answer("❌ Яндекс.Музыка сервис не настроен", show_alert=True)
         return
-        
+
     status_msg = await query.message.edit_text("🔄 Загружаю плейлисты Яндекс.Музыки...")
-    
+
     playlists = await music_service.get_yandex_playlists()
     if not playlists:
         await status_msg.edit_text("❌ Не удалось получить плейлисты Яндекс.Музыки")
         return
-        
-    await state.update_data(yandex_playlists=playlists)
-    
+
     playlist_text = f"📂 **Ваши плейлисты Яндекс.Музыки** ({len(playlists)} шт.)\\n\\nВыберите плейлист:"
-    await status_msg.edit_text(playlist_text, 
-                               reply_markup=paginated_keyboard(playlists, "ypl"),
+    await status_msg.edit_text(playlist_text,
+                               reply_markup=playlists_keyboard(playlists, "y"),
                                parse_mode="Markdown")
 
-@dp.callback_query(F.data.startswith("ypl_"))
+@dp.callback_query(F.data.regexp(r"^y:\\d+$"))
 async def yandex_playlist_select_handler(query: CallbackQuery, state: FSMContext):
-    data = await state.get_data()
-    playlists = data.get("yandex_playlists", [])
-    parts = query.data.split("_")
-    idx = int(parts[1])
-    page = int(parts[2])
-    
+    playlists = await music_service.get_yandex_playlists()
+    idx = int(query.data.split(":")[1])
+
     if idx >= len(playlists):
         await query.answer("❌ Плейлист не найден")
         return
-        
+
     playlist = playlists[idx]
-    
-    status_msg = await query.message.edit_text(f"🔄 Загружаю треки из: **{playlist['title']}**", 
+
+    status_msg = await query.message.edit_text(f"🔄 Загружаю треки из: **{playlist['title']}**",
                                                parse_mode="Markdown")
-    
-    tracks = await music_service.get_yandex_playlist_tracks(playlist['id'])
+
+    tracks = await music_service.playlist_tracks(f"ya:{playlist['id']}")
     if not tracks:
         await status_msg.edit_text("❌ Не удалось получить треки плейлиста")
         return
-        
-    await state.update_data(yandex_tracks=tracks, current_playlist=playlist['title'])
-    
-    tracks_text = f"🎵 **{playlist['title']}** ({len(tracks)} треков)\\n\\nВыберите трек для скачивания:"
-    await status_msg.edit_text(tracks_text, 
-                               reply_markup=paginated_keyboard(tracks, "ytr", 0),
+
+    await state.update_data(tracks=tracks.handle, page=0)
+
+    await status_msg.edit_text(tracks_text(tracks),
+                               reply_markup=tracks_keyboard(tracks, 0),
                                parse_mode="Markdown")
 
-@dp.callback_query(F.data.startswith("ytr_"))
-async def yandex_track_select_handler(query: CallbackQuery, state: FSMContext):
+@dp.callback_query(F.data.regexp(r"^t:\\d+$"))
+async def track_select_handler(query: CallbackQuery, state: FSMContext):
     data = await state.get_data()
-    tracks = data.get("yandex_tracks", [])
-    current_playlist = data.get("current_playlist", "плейлист")
-    parts = query.data.split("_")
-    idx = int(parts[1])
-    page = int(parts[2])
-    
-    if idx >= len(tracks):
+    idx = int(query.data.split(":")[1])
+    page = data.get("page", 0)
+    tracks = await music_service.playlist_tracks(data.get("tracks"), max(idx + 1, (page + 2) * PAGE_SIZE))
+
+    if not tracks or idx >= len(tracks):
         await query.answer("❌ Трек не найден")
         return
-        
-    track = tracks[idx]
-    
+
+    title = tracks.titles[idx]
+
     status_msg = await query.message.edit_text(
-        f"🔄 Скачиваю: **{track['title']}**\\n\\n⏳ Поиск на YouTube...",
+        f"🔄 Скачиваю: **{title}**\\n\\n⏳ Поиск на YouTube...",
         parse_mode="Markdown"
     )
-    
-    file_path = await downloader.download_track(track['title'])
+
+    file_path = await downloader.download_track(title)
     if file_path:
-        await status_msg.edit_text(f"📤 Отправляю: **{track['title']}**", parse_mode="Markdown")
-        
-        with open(file_path, "rb") as audio_file:
-            await query.message.answer_audio(
-                audio=audio_file,
-                caption=f"🎵 {track['title']}\\n📂 Плейлист: {current_playlist}\\n📍 Источник: Яндекс → YouTube",
-                parse_mode="Markdown"
-            )
+        await status_msg.edit_text(f"📤 Отправляю: **{title}**", parse_mode="Markdown")
+
+        await query.message.answer_audio(
+            audio=FSInputFile(file_path),
+            caption=f"🎵 {title}\\n📂 Плейлист: {tracks.title}\\n📍 Источник: {SOURCES[tracks.handle.split(':')[0]]}",
+            parse_mode="Markdown"
+        )
         downloader.cleanup_file(file_path)
     else:
         await query.answer("❌ Не удалось скачать трек", show_alert=True)
-    
-    # Возвращаемся к списку треков
-    tracks_text = f"🎵 **{current_playlist}** ({len(tracks)} треков)\\n\\nВыберите следующий трек:"
-    await status_msg.edit_text(tracks_text, 
-                               reply_markup=paginated_keyboard(tracks, "ytr", page),
+
+    # Возвращаемся к списку треков на той странице, где был пользователь
+    await status_msg.edit_text(tracks_text(tracks, "Выберите следующий трек:"),
+                               reply_markup=tracks_keyboard(tracks, page),
                                parse_mode="Markdown")
 
 # Навигация по страницам
-@dp.callback_query(F.data.startswith(("vkpl_page_", "vktr_page_", "ypl_page_", "ytr_page_")))
+@dp.callback_query(F.data.regexp(r"^[vyt]:p\\d+$"))
 async def page_navigation_handler(query: CallbackQuery, state: FSMContext):
-    data = await state.get_data()
-    parts = query.data.split("_")
-    prefix = "_".join(parts[:-2])  # vkpl, vktr, ypl, ytr
-    page = int(parts[-1])
-    
-    if prefix == "vkpl":
-        items = data.get("vk_playlists", [])
-        text = f"📂 **Ваши плейлисты ВК** ({len(items)} шт.)\\n\\nВыберите плейлист:"
-    elif prefix == "vktr":
-        items = data.get("vk_tracks", [])
-        current_playlist = data.get("current_playlist", "плейлист")
-        text = f"🎵 **{current_playlist}** ({len(items)} треков)\\n\\nВыберите трек для скачивания:"
-    elif prefix == "ypl":
-        items = data.get("yandex_playlists", [])
-        text = f"📂 **Ваши плейлисты Яндекс.Музыки** ({len(items)} шт.)\\n\\nВыберите плейлист:"
-    elif prefix == "ytr":
-        items = data.get("yandex_tracks", [])
-        current_playlist = data.get("current_playlist", "плейлист")
-        text = f"🎵 **{current_playlist}** ({len(items)} треков)\\n\\nВыберите трек для скачивания:"
+    prefix, page = query.data.split(":")  # v — плейлисты ВК, y — Яндекса, t — треки
+    page = int(page[1:])
+
+    if prefix == "v":
+        playlists = await music_service.get_vk_playlists()
+        text = f"📂 **Ваши плейлисты ВК** ({len(playlists)} шт.)\\n\\nВыберите плейлист:"
+        keyboard = playlists_keyboard(playlists, prefix, page)
+    elif prefix == "y":
+        playlists = await music_service.get_yandex_playlists()
+        text = f"📂 **Ваши плейлисты Яндекс.Музыки** ({len(playlists)} шт.)\\n\\nВыберите плейлист:"
+        keyboard = playlists_keyboard(playlists, prefix, page)
     else:
-        await query.answer("❌ Ошибка навигации")
+        data = await state.get_data()
+        tracks = await music_service.playlist_tracks(data.get("tracks"), (page + 2) * PAGE_SIZE)
+        if not tracks:
+            await query.answer("❌ Плейлист не найден")
+            return
+        await state.update_data(page=page)
+        text = tracks_text(tracks)
+        keyboard = tracks_keyboard(tracks, page)
+
+    # Повторное нажатие на ту же страницу не тратит запрос к Bot API
+    await show_page(query.message, text, keyboard)
+
+@dp.callback_query(F.data == "t:all")
+async def playlist_download_handler(query: CallbackQuery, state: FSMContext):
+    data = await state.get_data()
+    tracks = await music_service.playlist_tracks(data.get("tracks"), PLAYLIST_MAX_TRACKS)
+    if not tracks:
+        await query.answer("❌ Плейлист не найден")
         return
-    
-    await query.message.edit_text(text, 
-                                  reply_markup=paginated_keyboard(items, prefix, page),
-                                  parse_mode="Markdown")
+
+    chat_id = query.message.chat.id
+    job = playlist_jobs.get(chat_id)
+    if job and not job.done():
+        await query.answer("⏳ Плейлист уже скачивается", show_alert=True)
+        return
+
+    await query.answer(f"⬇️ Скачиваю {min(len(tracks), PLAYLIST_MAX_TRACKS)} треков")
+    job = asyncio.create_task(download_playlist(query.message, tracks))
+    playlist_jobs[chat_id] = job
+    job.add_done_callback(lambda t: playlist_jobs.pop(chat_id, None) if playlist_jobs.get(chat_id) is t else None)
+
+@dp.callback_query(F.data == "playlist_stop")
+async def playlist_stop_handler(query: CallbackQuery):
+    job = playlist_jobs.get(query.message.chat.id)
+    if job and not job.done():
+        job.cancel()
+        await query.answer("⏹ Останавливаю")
+    else:
+        await query.answer("Загрузка уже завершена")
 
 @dp.callback_query(F.data == "help")
 async def help_handler(query: CallbackQuery):
@@ -536,7 +904,7 @@ async def help_handler(query: CallbackQuery):
 Бот использует технические токены для безопасного доступа к ВК и Яндекс.Музыке без необходимости вводить личные данные."""
     
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton("🏠 Главное меню", callback_data="main_menu")]
+        [InlineKeyboardButton(text="🏠 Главное меню", callback_data="main_menu")]
     ])
     
     await query.message.edit_text(help_text, reply_markup=keyboard, parse_mode="Markdown")
@@ -567,12 +935,11 @@ async def direct_search_handler(message: Message):
         if file_path:
             await status_msg.edit_text(f"📤 Отправляю: **{query}**", parse_mode="Markdown")
             
-            with open(file_path, "rb") as audio_file:
-                await message.answer_audio(
-                    audio=audio_file,
-                    caption=f"🎵 {query}\\n📍 Источник: YouTube",
-                    parse_mode="Markdown"
-                )
+            await message.answer_audio(
+                audio=FSInputFile(file_path),
+                caption=f"🎵 {query}\\n📍 Источник: YouTube",
+                parse_mode="Markdown"
+            )
             downloader.cleanup_file(file_path)
             
             # Удаляем сообщение о статусе
@@ -608,11 +975,18 @@ async def main():
             logger.info("✅ FFmpeg found")
         
         logger.info("🚀 Bot started successfully!")
-        await dp.start_polling(bot, skip_updates=True)
+        janitor = asyncio.create_task(music_service.tracks.run())
+        try:
+            await dp.start_polling(bot, skip_updates=True)
+        finally:
+            janitor.cancel()
         
     except Exception as e:
         logger.error(f"❌ Bot startup error: {e}")
     finally:
+        for job in list(playlist_jobs.values()):
+            job.cancel()
+        await dp.storage.close()
         await bot.session.close()
 
 if __name__ == "__main__":
@@ -0,0 +1,85 @@
+import os
+import sys
+import time
+import unittest
+from unittest import mock
+
+os.environ.setdefault("BOT_TOKEN", "123456:test")
+os.environ.setdefault("FILE_CACHE_PATH", ":memory:")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiogram.exceptions import TelegramBadRequest  # noqa: E402
+from aiogram.methods import SendAudio  # noqa: E402
+
+import music_bot  # noqa: E402
+from music_bot import FileIdCache  # noqa: E402
+
+
+class FileIdCacheTest(unittest.TestCase):
+    """Telegram file_id cache: lookups by any key, expiry, eviction and invalidation."""
+
+    def setUp(self):
+        self.cache = FileIdCache(":memory:", ttl=60, max_entries=3)
+
+    def test_put_get_any_key(self):
+        self.cache.put("F1", "YouTube", "query", "youtube:abc")
+        self.assertEqual(self.cache.get("youtube:abc"), ("F1", "YouTube"))
+        self.assertEqual(self.cache.get(None, "missing", "query"), ("F1", "YouTube"))
+        self.assertIsNone(self.cache.get("missing"))
+        stats = self.cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["size"]), (2, 1, 2))
+
+    def test_expired_entries_are_dropped(self):
+        self.cache.put("F1", "YouTube", "query")
+        with mock.patch("music_bot.time.time", return_value=time.time() + 61):
+            self.assertIsNone(self.cache.get("query"))
+        self.assertEqual(self.cache.stats()["size"], 0)
+
+    def test_least_recently_used_is_evicted(self):
+        for i in range(3):
+            self.cache.put(f"F{i}", "YouTube", f"k{i}")
+            time.sleep(0.01)
+        self.cache.get("k0")
+        self.cache.put("F3", "YouTube", "k3")
+        self.assertIsNotNone(self.cache.get("k0"))
+        self.assertIsNone(self.cache.get("k1"))
+        self.assertEqual(self.cache.stats()["size"], 3)
+
+    def test_invalidate_removes_every_key_of_a_file(self):
+        self.cache.put("F1", "YouTube", "query", "youtube:abc")
+        self.cache.put("F2", "Zaycev.net", "other")
+        self.cache.invalidate("F1")
+        self.assertIsNone(self.cache.get("query", "youtube:abc"))
+        self.assertEqual(self.cache.get("other"), ("F2", "Zaycev.net"))
+        self.assertEqual(self.cache.stats()["invalidated"], 1)
+
+
+class SendCachedTest(unittest.IsolatedAsyncioTestCase):
+    """Only errors about the file itself evict a cached file_id."""
+
+    async def asyncSetUp(self):
+        self.cache = FileIdCache(":memory:", ttl=60, max_entries=10)
+        patcher = mock.patch.object(music_bot, "file_cache", self.cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.cache.put("F1", "YouTube", "query")
+
+    def message(self, error):
+        async def answer_audio(*args, **kwargs):
+            raise TelegramBadRequest(SendAudio(chat_id=1, audio="F1"), error)
+        return mock.Mock(answer_audio=answer_audio)
+
+    async def test_wrong_file_id_is_evicted(self):
+        m = self.message("Bad Request: wrong file identifier/HTTP URL specified")
+        self.assertFalse(await music_bot.send_cached(m, "F1", "caption"))
+        self.assertIsNone(self.cache.get("query"))
+
+    async def test_other_errors_keep_the_entry(self):
+        m = self.message("Bad Request: chat not found")
+        with self.assertRaises(TelegramBadRequest):
+            await music_bot.send_cached(m, "F1", "caption")
+        self.assertEqual(self.cache.get("query"), ("F1", "YouTube"))
+
+
+if __name__ == "__main__":
+    unittest.main()
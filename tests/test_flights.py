@@ -0,0 +1,87 @@
+import asyncio
+import os
+import sys
+import unittest
+
+os.environ.setdefault("BOT_TOKEN", "123456:test")
+os.environ.setdefault("FILE_CACHE_PATH", ":memory:")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import music_bot  # noqa: E402
+from music_bot import Candidate, Job  # noqa: E402
+
+
+class CrossFlightTest(unittest.IsolatedAsyncioTestCase):
+    """Two flights whose fallbacks land on each other's candidates."""
+
+    async def asyncSetUp(self):
+        self.flights = music_bot.SingleFlight()
+        self.orig_flights, music_bot.flights = music_bot.flights, self.flights
+        self.downloader = music_bot.MultiSourceDownloader()
+        self.downloader.sources = (
+            ("YouTube", "searching_youtube", None, self.fetch_youtube),
+            ("Zaycev.net", "searching_zaycev", None, self.fetch_zaycev),
+        )
+        self.youtube = Candidate("youtube", "K", duration=60)
+        self.zaycev = Candidate("zaycev", "Z", duration=60)
+        self.jobs = {}
+        self.b_started = asyncio.Event()
+
+    async def asyncTearDown(self):
+        music_bot.flights = self.orig_flights
+
+    async def fetch_youtube(self, cand, job):
+        if job is self.jobs["a"]:
+            await self.b_started.wait()
+            return None
+        return "/tmp/k.mp3"
+
+    async def fetch_zaycev(self, cand, job):
+        # Fail only once A is parked on B, so B's fallback meets A's key
+        while self.jobs["a"].flight.waiting is None:
+            await asyncio.sleep(0.01)
+        return None
+
+    def factory(self, name, first, second):
+        async def run(flight, notify):
+            job = Job(name, "/tmp")
+            job.flight = job.owner = flight
+            self.jobs[name] = job
+            if name == "b":
+                self.b_started.set()
+            res = await self.downloader._deliver(*first, job)
+            if not res:
+                res = await self.downloader._deliver(*second, job)
+            return res, name, job
+        return run
+
+    async def request(self, key, name, first, second):
+        async with self.flights.join(key, self.factory(name, first, second)) as (res, _, _):
+            return res
+
+    async def launch(self):
+        a = asyncio.ensure_future(self.request("a", "a", (0, self.youtube), (1, self.zaycev)))
+        while "a" not in self.jobs:
+            await asyncio.sleep(0)
+        b = asyncio.ensure_future(self.request("b", "b", (1, self.zaycev), (0, self.youtube)))
+        return a, b
+
+    async def test_fallbacks_onto_each_other_do_not_deadlock(self):
+        a, b = await self.launch()
+        results = await asyncio.wait_for(asyncio.gather(a, b), 2)
+        self.assertEqual(results, ["/tmp/k.mp3", "/tmp/k.mp3"])
+        self.assertFalse(self.flights.flights)
+
+    async def test_cancel_while_joined(self):
+        a, b = await self.launch()
+        while self.jobs["a"].flight.waiting is None:
+            await asyncio.sleep(0.01)
+        a.cancel()
+        b.cancel()
+        done, pending = await asyncio.wait({a, b}, timeout=2)
+        self.assertFalse(pending)
+        self.assertFalse(self.flights.flights)
+
+
+if __name__ == "__main__":
+    unittest.main()
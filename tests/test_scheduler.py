@@ -0,0 +1,122 @@
+import asyncio
+import os
+import sys
+import unittest
+
+os.environ.setdefault("BOT_TOKEN", "123456:test")
+os.environ.setdefault("FILE_CACHE_PATH", ":memory:")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from music_bot import DownloadScheduler, SchedulerFull  # noqa: E402
+
+
+class SchedulerTest(unittest.IsolatedAsyncioTestCase):
+    """Round-robin slots across chats, queue positions and cancellation."""
+
+    async def asyncSetUp(self):
+        self.scheduler = DownloadScheduler(1, 2, 10)
+        self.started = []
+        self.positions = {}
+        self.release = asyncio.Event()
+
+    async def run_job(self, name, chat_id, user_id):
+        async def on_position(pos):
+            self.positions.setdefault(name, []).append(pos)
+        async with self.scheduler.slot(chat_id, user_id, on_position):
+            self.started.append(name)
+            await self.release.wait()
+
+    async def settle(self):
+        for _ in range(5):
+            await asyncio.sleep(0)
+
+    async def test_chats_take_turns(self):
+        blocker = asyncio.ensure_future(self.run_job("blocker", 0, 0))
+        await self.settle()
+        jobs = [asyncio.ensure_future(self.run_job(name, chat, user)) for name, chat, user in
+                (("a1", 1, 1), ("a2", 1, 2), ("a3", 1, 3), ("b1", 2, 4), ("c1", 3, 5))]
+        await self.settle()
+        self.assertEqual(self.scheduler.stats()["queued"], 5)
+        self.release.set()
+        await asyncio.wait_for(asyncio.gather(blocker, *jobs), 2)
+        self.assertEqual(self.started, ["blocker", "a1", "b1", "c1", "a2", "a3"])
+        self.assertEqual(self.scheduler.stats()["active"], 0)
+
+    async def test_positions_follow_the_order(self):
+        blocker = asyncio.ensure_future(self.run_job("blocker", 0, 0))
+        await self.settle()
+        a1 = asyncio.ensure_future(self.run_job("a1", 1, 1))
+        await self.settle()
+        a2 = asyncio.ensure_future(self.run_job("a2", 1, 2))
+        await self.settle()
+        b1 = asyncio.ensure_future(self.run_job("b1", 2, 3))
+        await self.settle()
+        # b1's chat has nothing running yet, so it goes ahead of a2
+        self.assertEqual(self.positions, {"a1": [1], "a2": [2, 3], "b1": [2]})
+        self.release.set()
+        await asyncio.wait_for(asyncio.gather(blocker, a1, a2, b1), 2)
+
+    async def test_cancelled_ticket_leaves_the_queue(self):
+        blocker = asyncio.ensure_future(self.run_job("blocker", 0, 0))
+        await self.settle()
+        a1 = asyncio.ensure_future(self.run_job("a1", 1, 1))
+        b1 = asyncio.ensure_future(self.run_job("b1", 2, 2))
+        await self.settle()
+        a1.cancel()
+        await self.settle()
+        self.assertEqual(self.scheduler.stats()["queued"], 1)
+        self.assertEqual(self.positions["b1"], [2, 1])
+        self.release.set()
+        await asyncio.wait_for(asyncio.gather(blocker, b1), 2)
+        self.assertEqual(self.started, ["blocker", "b1"])
+        self.assertFalse(self.scheduler.inflight)
+
+    async def test_limits(self):
+        blocker = asyncio.ensure_future(self.run_job("blocker", 0, 0))
+        second = asyncio.ensure_future(self.run_job("second", 0, 0))
+        await self.settle()
+        with self.assertRaises(SchedulerFull) as busy:
+            async with self.scheduler.slot(0, 0):
+                pass
+        self.assertEqual(busy.exception.reason, "user_busy")
+        self.scheduler.max_queued = 1
+        with self.assertRaises(SchedulerFull) as full:
+            async with self.scheduler.slot(1, 1):
+                pass
+        self.assertEqual(full.exception.reason, "queue_full")
+        self.release.set()
+        await asyncio.wait_for(asyncio.gather(blocker, second), 2)
+
+
+class NotifyThrottleTest(unittest.IsolatedAsyncioTestCase):
+    """Position edits are rate-limited per ticket and end on the latest position."""
+
+    async def test_moves_are_folded(self):
+        scheduler = DownloadScheduler(1, 10, 100, notify_interval=0.2)
+        edits = []
+        gates = [asyncio.Event() for _ in range(6)]
+
+        async def run(i):
+            async def on_position(pos):
+                edits.append((i, pos))
+            async with scheduler.slot(i, i, on_position):
+                await gates[i].wait()
+
+        tasks = [asyncio.ensure_future(run(i)) for i in range(6)]
+        await asyncio.sleep(0.01)
+        self.assertEqual(edits, [(i, i) for i in range(1, 6)])
+        edits.clear()
+        # Three jobs finish inside one interval: the last ticket moves 5 -> 2 with no edit yet
+        for i in range(3):
+            gates[i].set()
+            await asyncio.sleep(0.01)
+        self.assertEqual([e for e in edits if e[0] == 5], [])
+        await asyncio.sleep(0.25)
+        self.assertEqual([e for e in edits if e[0] == 5], [(5, 2)])
+        for gate in gates:
+            gate.set()
+        await asyncio.wait_for(asyncio.gather(*tasks), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
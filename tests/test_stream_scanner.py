@@ -0,0 +1,63 @@
+import os
+import sys
+import unittest
+from pathlib import Path
+
+os.environ.setdefault("BOT_TOKEN", "123456:test")
+os.environ.setdefault("FILE_CACHE_PATH", ":memory:")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from music_bot import SCAN_OVERLAP, Bs4Extractor, StreamExtractor, StreamScanner  # noqa: E402
+
+FIXTURES = Path(__file__).resolve().parent.parent / "bench" / "fixtures"
+MP3 = "https://cdn.zaycev.net/download/10042/dream-light-summer-rain.mp3?expire=1900000000"
+
+
+def feed(scanner: StreamScanner, text: str, chunk: int):
+    for pos in range(0, len(text), chunk):
+        if scanner.feed(text[pos:pos + chunk]):
+            break
+    return scanner.result
+
+
+class StreamScannerTest(unittest.TestCase):
+    """Matches split across chunk boundaries, bounded rescans and the bs4 priority."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.search = (FIXTURES / "zaycev_search.html").read_text(encoding="utf-8")
+        cls.track = (FIXTURES / "zaycev_track.html").read_text(encoding="utf-8")
+
+    def test_any_chunk_size_finds_what_bs4_finds(self):
+        bs4 = Bs4Extractor()
+        for strict in (False, True):
+            extractor = StreamExtractor(strict=strict)
+            for chunk in (1, 7, 64, 1000, len(self.track)):
+                with self.subTest(strict=strict, chunk=chunk):
+                    self.assertEqual(feed(extractor.track_scanner(), self.track, chunk), MP3)
+                    self.assertEqual(feed(extractor.search_scanner(), self.search, chunk),
+                                     bs4.search_link(self.search))
+
+    def test_match_split_between_chunks(self):
+        page = "<p>" + "x" * 5000 + f'<audio><source src="{MP3}"></audio>'
+        split = page.index(".mp3") + 2
+        scanner = StreamExtractor(strict=True).track_scanner()
+        self.assertIsNone(scanner.feed(page[:split]))
+        self.assertEqual(scanner.feed(page[split:]), MP3)
+        self.assertEqual(scanner.text, page)
+
+    def test_search_buffer_stays_bounded(self):
+        scanner = StreamExtractor().track_scanner()
+        for _ in range(100):
+            scanner.feed("<div>" + "y" * 1000 + "</div>")
+        self.assertLessEqual(len(scanner.tail), SCAN_OVERLAP)
+
+    def test_strict_ignores_mp3_outside_audio(self):
+        page = f'<a href="/other.mp3">x</a><audio controls></audio><audio><source src="{MP3}"></audio>'
+        self.assertEqual(StreamExtractor().track_mp3(page), "/other.mp3")
+        self.assertEqual(StreamExtractor(strict=True).track_mp3(page), MP3)
+        self.assertIsNone(StreamExtractor(strict=True).track_mp3('<a href="/other.mp3">x</a>'))
+
+
+if __name__ == "__main__":
+    unittest.main()
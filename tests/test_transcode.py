@@ -0,0 +1,109 @@
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+os.environ.setdefault("BOT_TOKEN", "123456:test")
+os.environ.setdefault("FILE_CACHE_PATH", ":memory:")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from music_bot import MAX_FILE_SIZE, TranscodePolicy  # noqa: E402
+
+
+def fake_ffmpeg(calls, fail_copy=False):
+    def run(args):
+        calls.append(args)
+        if fail_copy and "copy" in args:
+            raise RuntimeError("ffmpeg exited with 1")
+        with open(args[-1], "wb") as f:
+            f.write(b"out")
+        return 0.5
+    return run
+
+
+class ChoiceTest(unittest.TestCase):
+    """native / remux / transcode selection per policy."""
+
+    def test_auto(self):
+        policy = TranscodePolicy("auto", 192, 1)
+        self.assertEqual(policy.choice("m4a", "mp4a.40.2", 1000), "native")
+        self.assertEqual(policy.choice("mp3", "mp3", None), "native")
+        self.assertEqual(policy.choice("webm", "mp4a.40.2", 1000), "remux")
+        self.assertEqual(policy.choice("webm", "opus", 1000), "transcode")
+        self.assertEqual(policy.choice("m4a", "mp4a.40.2", MAX_FILE_SIZE + 1), "transcode")
+
+    def test_remux(self):
+        policy = TranscodePolicy("remux", 192, 1)
+        self.assertEqual(policy.choice("m4a", "mp4a.40.2", 1000), "remux")
+        self.assertEqual(policy.choice("webm", "opus", 1000), "transcode")
+
+    def test_transcode(self):
+        policy = TranscodePolicy("transcode", 192, 1)
+        self.assertEqual(policy.choice("mp3", "mp3", 1000), "transcode")
+
+    def test_unknown_mode(self):
+        with self.assertRaises(ValueError):
+            TranscodePolicy("fast", 192, 1)
+
+    def test_bitrate_fits_the_size_limit(self):
+        policy = TranscodePolicy("auto", 192, 1)
+        self.assertEqual(policy.bitrate(0), 192)
+        self.assertEqual(policy.bitrate(180), 192)
+        long = policy.bitrate(3 * 3600)
+        self.assertLess(long, 192)
+        self.assertLessEqual(long * 1000 / 8 * 3 * 3600, MAX_FILE_SIZE)
+
+
+class ApplyTest(unittest.TestCase):
+    """apply() keeps native files, remuxes, and falls back to a transcode."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.calls = []
+
+    def source(self, name: str) -> str:
+        path = os.path.join(self.tmp.name, name)
+        with open(path, "wb") as f:
+            f.write(b"in")
+        return path
+
+    def test_native_is_returned_untouched(self):
+        policy = TranscodePolicy("auto", 192, 1)
+        src = self.source("youtube.m4a")
+        with mock.patch("music_bot.run_ffmpeg", fake_ffmpeg(self.calls)):
+            self.assertEqual(policy.apply(src, "mp4a.40.2", 180, os.path.join(self.tmp.name, "audio")), src)
+        self.assertEqual(self.calls, [])
+        self.assertEqual(policy.counts["native"], 1)
+
+    def test_remux_copies_the_stream(self):
+        policy = TranscodePolicy("auto", 192, 1)
+        src = self.source("youtube.webm")
+        with mock.patch("music_bot.run_ffmpeg", fake_ffmpeg(self.calls)):
+            out = policy.apply(src, "mp4a.40.2", 180, os.path.join(self.tmp.name, "audio"))
+        self.assertTrue(out.endswith("audio.m4a"))
+        self.assertIn("copy", self.calls[0])
+        self.assertEqual(policy.counts["remux"], 1)
+
+    def test_failed_remux_falls_back_to_transcode(self):
+        policy = TranscodePolicy("auto", 192, 2)
+        src = self.source("youtube.webm")
+        with mock.patch("music_bot.run_ffmpeg", fake_ffmpeg(self.calls, fail_copy=True)):
+            out = policy.apply(src, "mp4a.40.2", 180, os.path.join(self.tmp.name, "audio"))
+        self.assertTrue(out.endswith("audio.mp3"))
+        self.assertEqual(len(self.calls), 2)
+        self.assertIn("libmp3lame", self.calls[1])
+        self.assertEqual(self.calls[1][self.calls[1].index("-threads") + 1], "2")
+        self.assertEqual(policy.counts["transcode@192k"], 1)
+
+    def test_too_long_for_any_bitrate(self):
+        policy = TranscodePolicy("transcode", 192, 1)
+        src = self.source("youtube.webm")
+        with mock.patch("music_bot.run_ffmpeg", fake_ffmpeg(self.calls)):
+            self.assertEqual(policy.apply(src, "opus", 10 ** 6, os.path.join(self.tmp.name, "audio")), "TOO_BIG")
+        self.assertEqual(self.calls, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
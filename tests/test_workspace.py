@@ -0,0 +1,87 @@
+import asyncio
+import os
+import sys
+import tempfile
+import time
+import unittest
+
+os.environ.setdefault("BOT_TOKEN", "123456:test")
+os.environ.setdefault("FILE_CACHE_PATH", ":memory:")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from music_bot import Workspace  # noqa: E402
+
+
+class WorkspaceTest(unittest.IsolatedAsyncioTestCase):
+    """Quota admission, per-job cleanup and the orphan sweep."""
+
+    async def asyncSetUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = self.tmp.name
+        self.workspace = Workspace(self.root, quota=1000, reserve=100)
+        self.workspace.start(orphan_age=3600)
+
+    async def asyncTearDown(self):
+        self.tmp.cleanup()
+
+    def make(self, *parts, size=0, age=0):
+        path = os.path.join(self.root, *parts)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(b"x" * size)
+        if age:
+            stamp = time.time() - age
+            while path != self.root:
+                os.utime(path, (stamp, stamp))
+                path = os.path.dirname(path)
+        return os.path.join(self.root, *parts)
+
+    async def test_job_dir_is_removed_and_counted(self):
+        async with self.workspace.job() as path:
+            self.assertTrue(path.startswith(self.workspace.path))
+            with open(os.path.join(path, "audio.mp3"), "wb") as f:
+                f.write(b"x" * 300)
+            self.assertEqual(self.workspace.stats()["committed"], 300)
+        self.assertFalse(os.path.exists(path))
+        stats = self.workspace.stats()
+        self.assertEqual((stats["jobs"], stats["reclaimed"]), (0, 300))
+
+    async def test_admission_waits_for_actual_usage(self):
+        admitted = asyncio.Event()
+
+        async def second():
+            async with self.workspace.job():
+                admitted.set()
+
+        async with self.workspace.job() as path:
+            with open(os.path.join(path, "audio.mp3"), "wb") as f:
+                f.write(b"x" * 950)
+            task = asyncio.ensure_future(second())
+            await asyncio.sleep(0.05)
+            self.assertFalse(admitted.is_set())
+            self.assertEqual(self.workspace.stats()["waiting"], 1)
+        await asyncio.wait_for(admitted.wait(), 1)
+        await task
+
+    async def test_reservations_admit_up_to_quota(self):
+        async with self.workspace.job(), self.workspace.job():
+            self.assertEqual(self.workspace.stats()["committed"], 200)
+
+    async def test_sweep_leaves_live_jobs_and_foreign_files(self):
+        foreign = self.make("notes.txt", age=7200)
+        other_live = self.make("musicbot-other-1", "job_a", "audio.mp3")
+        other_dead = self.make("musicbot-dead-2", "job_b", "audio.mp3", age=7200)
+        legacy = self.make("job_old", "audio.mp3", age=7200)
+        async with self.workspace.job() as path:
+            leftover = self.make(os.path.basename(self.workspace.path), "job_left", "audio.mp3")
+            self.workspace.sweep(0, 3600)
+            self.assertTrue(os.path.isdir(path))
+        self.assertTrue(os.path.exists(foreign))
+        self.assertTrue(os.path.exists(other_live))
+        self.assertFalse(os.path.exists(other_dead))
+        self.assertFalse(os.path.exists(legacy))
+        self.assertFalse(os.path.exists(leftover))
+
+
+if __name__ == "__main__":
+    unittest.main()